@@ -0,0 +1,271 @@
+####################################################################
+# Benchmarks of the viewer's hot paths, runs without a display:
+#     python benchmark.py                     run and print the timings
+#     python benchmark.py -o results.json     save the timings
+#     python benchmark.py -c results.json     compare with saved timings, exits
+#                                             with 1 if anything got slower
+# Images and dots are synthetic, they're created in a temporary folder.
+####################################################################
+import viewer
+from viewer import TiledImage, ImagePyramid, DotStore
+from PIL import Image
+import numpy
+import sys
+import getopt
+import os
+import time
+import shutil
+import tempfile
+import json
+from collections import OrderedDict
+
+IMAGE_SIZES = [(800, 600), (2400, 1800), (6000, 4000)]  # the last two are zoomed out to fit the window
+DOT_COUNTS = [1000, 10000, 100000, 1000000]
+DOT_IMAGE = (6000, 4000)    # the dots are spread over an image this size, with the grid in its middle
+WINDOW = (800, 600)
+OVERSCAN = 256              # LoadImageApp.PAN_OVERSCAN
+ZOOMS = [-10, 0, 5]         # zoomcycles rendered, besides the one fitting the window
+THRESHOLD = 0.25            # a timing more than 25% over the baseline is a regression
+FLOOR = 0.002               # ... unless it's less than 2 ms over
+MUX = viewer.zoom_factors(viewer.LoadImageApp.MIN_ZOOM, viewer.LoadImageApp.MAX_ZOOM)
+
+
+def fit_zoom(size):
+    # the zoomcycle an image is opened with
+    return viewer.fit_zoom(size, MUX, viewer.LoadImageApp.MIN_ZOOM)
+
+def best_of(fn, repeat):
+
+    # the fastest of repeat runs, in seconds
+    best = None
+    for n in range(repeat):
+        start = time.time()
+        fn()
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+def make_image(folder, (w, h)):
+
+    # A gradient with noise, so the resampling and PNG decoding have work to do
+    ys, xs = numpy.mgrid[0:h, 0:w]
+    noise = numpy.random.RandomState(w).randint(0, 32, (h, w))
+    pixels = numpy.dstack(((xs * 255 // w + noise) % 256, (ys * 255 // h + noise) % 256, (xs + ys + noise) % 256))
+
+    image_file = os.path.join(folder, "bench_%dx%d.png" % (w, h))
+    Image.fromarray(pixels.astype(numpy.uint8), "RGB").save(image_file)
+    return image_file
+
+def make_dots(count, (w, h)):
+
+    rand = numpy.random.RandomState(count)
+    return rand.randint(0, w, count), rand.randint(0, h, count)
+
+def bench_image(results, image_file, size, repeat):
+
+    name = "%dx%d" % size
+
+    # Opening: decoding into the tiled store, and the pyramid
+    results["open %s" % name] = best_of(lambda: ImagePyramid(TiledImage(image_file)), repeat)
+
+    # Opening again, as after a restart: hashing the file, then mapping the decoded image and
+    # the pyramid level of the fitting zoom out of the tile cache
+    n = ImagePyramid(TiledImage(image_file)).nearest_level(MUX[fit_zoom(size)])
+    folder = os.path.join(os.path.dirname(image_file), "tiles")
+    os.mkdir(folder)
+
+    def open_cached():
+        cache = viewer.TileCache(folder)
+        ImagePyramid(TiledImage(image_file, cache), cache).level(n)
+    open_cached()
+    results["open cached %s" % name] = best_of(open_cached, repeat)
+    shutil.rmtree(folder)
+
+    raw_image = TiledImage(image_file)
+    fit = fit_zoom(size)
+
+    for zoomcycle in [fit] + [z for z in ZOOMS if z != fit]:
+        scale = MUX[zoomcycle]
+        label = "%s @ %d%%" % (name, scale * 100)
+
+        # building the pyramid level for the zoom (done on the render thread), on a fresh
+        # pyramid each time
+        pyramid = ImagePyramid(raw_image)
+        n = pyramid.nearest_level(scale)
+        results["pyramid level %s" % label] = best_of(lambda: ImagePyramid(raw_image).level(n), repeat)
+        pyramid.level(n)
+
+        # display_region: rendering the window around the center of the image (on the render
+        # thread), with and without the pan overscan, and the conversion of the result (show_region)
+        viewport = (int(size[0] * scale - WINDOW[0]) // 2, int(size[1] * scale - WINDOW[1]) // 2)
+        results["render %s" % label] = best_of(lambda: pyramid.render(viewport, WINDOW, scale), repeat)
+
+        panned = (viewport[0] - OVERSCAN, viewport[1] - OVERSCAN)
+        panned_size = (WINDOW[0] + 2 * OVERSCAN, WINDOW[1] + 2 * OVERSCAN)
+        results["render overscan %s" % label] = best_of(lambda: pyramid.render(panned, panned_size, scale), repeat)
+
+        # without a display it's another timing, so it's under another label
+        region = pyramid.render(viewport, WINDOW, scale)
+        kind = "convert" if photo_root is not None else "copy"
+        results["%s %s" % (kind, label)] = best_of(lambda: convert(region), repeat)
+
+def dot_grid():
+    return (DOT_IMAGE[0] // 2, DOT_IMAGE[1] // 2), DOT_IMAGE[1] // 2
+
+def bench_dots(results, folder, count, repeat, lookup):
+
+    name = "%d dots" % count
+    size = DOT_IMAGE
+    (center, radius) = dot_grid()
+    azimuth_coords = viewer.field_azimuth_end(center, radius, 30, (center[0] + radius, center[1]))
+    (xs, ys) = make_dots(count, size)
+
+    # find_angle() and find_horizon() over all the dots, and azimuth_calculation() with
+    # the rounding and the update of the dot store
+    def geometry():
+        viewer.find_angle_array(center, azimuth_coords, xs, ys)
+        viewer.find_horizon_array(viewer.dot_radius_array(center, xs, ys), radius)
+    results["find_angle/find_horizon %s" % name] = best_of(geometry, repeat)
+
+    dots = DotStore()
+    dots.add_many(xs, ys)
+
+    # update_dots() as azimuth_calculation() runs it: calculated, and looked up once the
+    # grid's HorizonLookup is built
+    results["azimuth_calculation %s" % name] = best_of(lambda: viewer.update_dots(dots, center, radius, azimuth_coords), repeat)
+    results["azimuth_calculation lookup %s" % name] = best_of(lambda: viewer.update_dots(dots, center, radius, azimuth_coords, lookup), repeat)
+
+    results["add_many %s" % name] = best_of(lambda: DotStore().add_many(xs, ys), repeat)
+
+    # the viewport query drawDots() does, for an 800 x 600 window at 100%
+    results["query %s" % name] = best_of(lambda: dots.query(center[0], center[1], center[0] + 800, center[1] + 600), repeat)
+
+    # CSV export (as save_csv()) and import (as open_csv(), all chunks at once)
+    csv_file = os.path.join(folder, "bench_%d.csv" % count)
+
+    def export():
+        f = open(csv_file, 'wb')
+        try:
+            viewer.write_dots_csv(f, dots.rows())
+        finally:
+            f.close()
+    results["csv export %s" % name] = best_of(export, repeat)
+
+    def import_csv():
+        store = DotStore()
+        for (chunk_xs, chunk_ys, done) in viewer.iter_dots_csv(csv_file, viewer.LoadImageApp.IMPORT_CHUNK):
+            store.add_many(chunk_xs, chunk_ys)
+    results["csv import %s" % name] = best_of(import_csv, repeat)
+
+def convert(region):
+
+    # The PhotoImage conversion needs Tk, without a display the pixel copy it starts with is timed
+    # (as "copy", it's not comparable with a conversion)
+    if photo_root is not None:
+        return viewer.ImageTk.PhotoImage(region)
+    return region.tobytes()
+
+def run(quick=False):
+
+    global photo_root
+    try:
+        photo_root = viewer.Tk()
+        photo_root.withdraw()
+    except viewer.TclError:
+        photo_root = None
+
+    repeat = 2 if quick else 5
+    results = OrderedDict()
+    folder = tempfile.mkdtemp()
+    try:
+        for size in IMAGE_SIZES[:2] if quick else IMAGE_SIZES:
+            image_file = make_image(folder, size)
+            bench_image(results, image_file, size, repeat)
+            print_new(results)
+
+        lookup = viewer.HorizonLookup(DOT_IMAGE, *dot_grid())
+        for count in DOT_COUNTS[:3] if quick else DOT_COUNTS:
+            bench_dots(results, folder, count, 1 if count >= 1000000 else repeat, lookup)
+            print_new(results)
+    finally:
+        shutil.rmtree(folder)
+
+    return results
+
+def print_new(results):
+
+    # print the timings added since the last call, so a long run shows its progress
+    for (label, seconds) in results.items():
+        if label not in printed:
+            print "%-50s %10.2f ms" % (label, seconds * 1000)
+            printed.add(label)
+
+def compare(results, baseline, threshold):
+
+    # Returns the labels that got slower than the baseline by more than threshold
+    slower = []
+    for (label, seconds) in results.items():
+        if label not in baseline:
+            continue
+        before = baseline[label]
+        change = (seconds - before) / before if before else 0
+        flag = ""
+        if seconds > before * (1 + threshold) and seconds - before > FLOOR:
+            slower.append(label)
+            flag = "  REGRESSION"
+        print "%-50s %10.2f ms %10.2f ms %+7.0f%%%s" % (label, before * 1000, seconds * 1000, change * 100, flag)
+    return slower
+
+photo_root = None
+printed = set()
+
+if __name__ == '__main__':
+    output_file = None
+    baseline_file = None
+    threshold = THRESHOLD
+    quick = False
+
+    opts, args = getopt.getopt(sys.argv[1:], 'o:c:t:qh')
+
+    for opt, arg in opts:
+        if opt == '-o':
+            output_file = arg
+        elif opt == '-c':
+            baseline_file = arg
+        elif opt == '-t':
+            threshold = float(arg) / 100
+        elif opt == '-q':
+            quick = True
+        elif opt == '-h':
+            print('Usage: python benchmark.py -q -o <results_file> -c <baseline_file> -t <percent>')
+            print('       -q     quick run, smaller images and dot sets, fewer repeats')
+            print('       -o <results_file>   save the timings as JSON')
+            print('       -c <baseline_file>  compare with timings saved by -o, exits with 1 on regressions')
+            print('       -t <percent>        slowdown counted as a regression (default 25)')
+            sys.exit()
+
+    results = run(quick)
+
+    if output_file:
+        f = open(output_file, 'w')
+        try:
+            json.dump(OrderedDict([("python", sys.version.split()[0]),
+                                   ("numpy", numpy.__version__),
+                                   ("timings", results)]), f, indent=2)
+        finally:
+            f.close()
+
+    if baseline_file:
+        f = open(baseline_file)
+        try:
+            baseline = json.load(f)["timings"]
+        finally:
+            f.close()
+
+        print
+        print "%-50s %13s %13s %8s" % ("", "baseline", "now", "change")
+        slower = compare(results, baseline, threshold)
+        if slower:
+            print "%d of %d timings are more than %d%% slower" % (len(slower), len(results), threshold * 100)
+            sys.exit(1)
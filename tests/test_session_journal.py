@@ -0,0 +1,92 @@
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+import numpy
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import viewer
+
+
+class SessionJournalTest(unittest.TestCase):
+
+    SIZE = (400, 300)
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.session_file = os.path.join(self.folder, "image.session")
+        self.journal_file = self.session_file + ".journal"
+
+        # a session saved with 2 dots, and its journal started as save_session() does
+        dots = viewer.DotStore()
+        dots.add_many([10, 20], [30, 40])
+        grid = ((200, 150), 250, True, (0, 0), -1, (0, 0))
+        self.stamp = viewer.write_session(self.session_file, "image.png", grid, dots.columns(), dots.next_id)
+        self.next_id = dots.next_id
+        viewer.SessionJournal(self.journal_file, self.stamp).close()
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def add_dots(self, journal, xs):
+        ids = numpy.arange(self.next_id, self.next_id + len(xs))
+        nans = numpy.full(len(xs), numpy.nan)
+        journal.dots_added(ids, numpy.array(xs), numpy.array(xs), nans, nans)
+        self.next_id += len(xs)
+
+    def reopen(self):
+        # what apply_session() does: replay the journal and go on with it
+        (records, journal) = viewer.open_journal(self.journal_file, self.stamp)
+        session = viewer.ServedSession(self.SIZE)
+        (stamp, image_file, grid, next_id, columns, lines) = viewer.read_session(self.session_file)
+        session.dots.load(*(columns + (next_id,)))
+        viewer.replay_journal(session, records)
+        return session, journal
+
+    def dot_count(self):
+        return len(viewer.ServedSession(self.SIZE, self.session_file).dots)
+
+    def test_torn_record(self):
+        (session, journal) = self.reopen()
+        self.add_dots(journal, [50])
+        journal.close()
+
+        # a crash in the middle of a write leaves part of a record
+        f = open(self.journal_file, 'ab')
+        f.write("\x01" * (viewer.SessionJournal.RECORD.itemsize // 2))
+        f.close()
+
+        (session, journal) = self.reopen()
+        self.assertEqual(len(session.dots), 3)
+        self.add_dots(journal, [60, 70])
+        journal.close()
+
+        self.assertEqual(self.dot_count(), 5)
+        self.assertEqual(os.path.getsize(self.journal_file) % viewer.SessionJournal.RECORD.itemsize, 0)
+
+    def test_missing_journal(self):
+        os.remove(self.journal_file)
+
+        (session, journal) = self.reopen()
+        self.assertEqual(len(session.dots), 2)
+        self.add_dots(journal, [50])
+        journal.close()
+
+        self.assertEqual(self.dot_count(), 3)
+
+    def test_foreign_journal(self):
+        # the journal of another save of the session
+        viewer.SessionJournal(self.journal_file, self.stamp ^ 1).close()
+
+        (session, journal) = self.reopen()
+        self.assertEqual(len(session.dots), 2)
+        self.add_dots(journal, [50])
+        journal.close()
+
+        self.assertEqual(self.dot_count(), 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
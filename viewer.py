@@ -4,17 +4,32 @@ except ImportError:
     from tkinter import *
 
 from PIL import Image, ImageTk
+import numpy
 import sys
 import getopt
 import os
 import math
+import time
+import mmap
+import tempfile
 import csv
+import struct
+import threading
 import tkFileDialog
 import tkMessageBox
 
 import tkSimpleDialog
 
 import logging
+import json
+import atexit
+import hashlib
+
+from collections import OrderedDict
+from cStringIO import StringIO
+
+# multiprocessing (for the image loader's pool and batch mode) is imported where
+# it's first needed, so the window comes up without it
 
 ####################################################################
 # Class: GridDialog
@@ -90,6 +105,1563 @@ class GridDialog(tkSimpleDialog.Dialog):
         self.result = True
 
 
+####################################################################
+# Class: TiledImage
+# Full resolution backing store of the raw image. The pixels are kept in a
+# memory mapped file: the image file itself for uncompressed formats (PPM,
+# PGM, raw TIFF), otherwise a temporary file that the decoded image is
+# spilled into once. Tiles of TILE_SIZE are only made into PIL images when
+# a region is requested, and at most MAX_TILES of them are kept around.
+# With a TileCache, the decoded image is spilled into the cache instead and
+# mapped from there, the next time the image is opened too.
+####################################################################
+class TiledImage:
+
+    TILE_SIZE = 256
+    MAX_TILES = 192        # decoded tiles kept in memory, 192 RGB tiles is about 36MB
+    MODES = ("L", "RGB", "RGBA")
+
+    def __init__(self, image_file, cache=None):
+
+        image = Image.open(image_file)
+        self.size = (w, h) = image.size
+        self.key = None         # content hash of the image file in the cache
+
+        if image.mode in self.MODES:
+            mode = image.mode
+        elif image.mode in ("LA", "PA") or "transparency" in image.info:
+            mode = "RGBA"
+        else:
+            mode = "RGB"
+
+        if cache is not None and mode in cache.MODES:
+            # An uncompressed file is mapped as is, only its pyramid levels are cached
+            self.key = cache.key(image_file)
+            if not self.mappable(image):
+                cached = cache.find(self.key, 0)
+                if cached is None:
+                    cached = cache.store(self.key, 0, image if image.mode == mode else image.convert(mode))
+                image = Image.open(cached)
+
+        if self.mappable(image):
+            # Map the pixel data of the file as is, nothing is decoded here
+            self.mode = image.mode
+            self._file = open(image.filename, "rb")
+            self._data = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+            self._offset = image.tile[0][2]
+            logging.debug('TiledImage: mapping %s directly', image.filename)
+        else:
+            # Decode once and spill the pixels into a temporary file, one strip at a time
+            self.mode = mode
+            if image.mode != self.mode:
+                image = image.convert(self.mode)
+
+            self._file = tempfile.TemporaryFile()
+            for y in xrange(0, h, self.TILE_SIZE):
+                self._file.write(image.crop((0, y, w, min(h, y + self.TILE_SIZE))).tobytes())
+            self._file.flush()
+            self._data = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+            self._offset = 0
+            logging.debug('TiledImage: decoded %s into a %d byte backing file', image_file, len(self._data))
+
+        self._bpp = len(self.mode)
+        self._stride = w * self._bpp
+        self.nbytes = h * self._stride      # size of the decoded image
+        self._tiles = OrderedDict()     # (tx,ty) -> Image, least recently used first
+        self._lock = threading.Lock()   # the tiles are cut on the render and loader threads
+
+    def mappable(self, image):
+
+        # Only a single uncompressed, top-down tile in one of our modes can be mapped directly
+        if len(image.tile) != 1 or image.mode not in self.MODES:
+            return False
+
+        (decoder, extents, offset, args) = image.tile[0]
+        if not isinstance(args, tuple):
+            args = (args, 0, 1)
+        (w, h) = image.size
+
+        return (decoder == "raw" and extents == (0, 0, w, h) and args[0] == image.mode
+                and args[1] in (0, w * len(image.mode)) and args[2] == 1
+                and os.path.getsize(image.filename) >= offset + w * h * len(image.mode))
+
+    def tile(self, tx, ty):
+
+        key = (tx, ty)
+        with self._lock:
+            tile = self._tiles.pop(key, None)
+
+            if tile is None:
+                (w, h) = self.size
+                x0, y0 = tx * self.TILE_SIZE, ty * self.TILE_SIZE
+                x1, y1 = min(w, x0 + self.TILE_SIZE), min(h, y0 + self.TILE_SIZE)
+
+                # Gather the tile rows out of the mapped file
+                start = self._offset + x0 * self._bpp
+                length = (x1 - x0) * self._bpp
+                rows = [self._data[start + y * self._stride:start + y * self._stride + length] for y in xrange(y0, y1)]
+                tile = Image.frombytes(self.mode, (x1 - x0, y1 - y0), "".join(rows))
+
+                if len(self._tiles) >= self.MAX_TILES:
+                    self._tiles.popitem(last=False)
+
+            self._tiles[key] = tile
+        return tile
+
+    def crop(self, box):
+
+        # Same as Image.crop(), the area outside of the image is left black
+        (x0, y0, x1, y1) = box
+        (w, h) = self.size
+        region = Image.new(self.mode, (x1 - x0, y1 - y0))
+
+        for ty in xrange(max(0, y0) // self.TILE_SIZE, (min(h, y1) - 1) // self.TILE_SIZE + 1):
+            for tx in xrange(max(0, x0) // self.TILE_SIZE, (min(w, x1) - 1) // self.TILE_SIZE + 1):
+                region.paste(self.tile(tx, ty), (tx * self.TILE_SIZE - x0, ty * self.TILE_SIZE - y0))
+
+        return region
+
+
+####################################################################
+# Class: ToneMap
+# Lookup table from 16 bit samples to 8 bit display values. black and white
+# are the samples shown as 0 and 255 at no exposure or contrast change;
+# exposure (in stops) and contrast (a factor around mid gray) adjust them.
+# The table is only built again when one of them changes.
+####################################################################
+class ToneMap:
+
+    def __init__(self, black, white):
+        self.black = black
+        self.white = max(black + 1, white)
+        self.exposure = 0.0
+        self.contrast = 1.0
+        self._lut = None        # (settings, table) of the last table built
+
+    def lut(self):
+
+        # The settings and table go together in one tuple, so the render thread never
+        # gets a table built for other settings than the ones it read
+        settings = (self.black, self.white, self.exposure, self.contrast)
+        lut = self._lut
+        if lut is None or lut[0] != settings:
+            values = (numpy.arange(65536) - self.black) * (2.0 ** self.exposure / (self.white - self.black))
+            values = (values - 0.5) * self.contrast + 0.5
+            lut = self._lut = (settings, (numpy.clip(values, 0.0, 1.0) * 255 + 0.5).astype(numpy.uint8))
+
+        return lut[1]
+
+
+####################################################################
+# Class: HighBitImage
+# A 16 bit image (grayscale, RGB or RGBA) as a (height, width, bands) array,
+# memory mapped from the file when its pixels are stored uncompressed. The
+# samples are only tone mapped to 8 bits (through the ToneMap shared by all
+# the pyramid levels) for the regions cropped out of it, so changing the
+# exposure or contrast never reads the pixels again. The pyramid levels made
+# by reduce() are 16 bit as well.
+####################################################################
+class HighBitImage:
+
+    # rawmode of the file -> (sample dtype, bands)
+    RAWMODES = {"I;16": ("<u2", 1), "I;16L": ("<u2", 1), "I;16B": (">u2", 1), "I;16N": ("=u2", 1),
+                "RGB;16L": ("<u2", 3), "RGB;16B": (">u2", 3), "RGBX;16L": ("<u2", 4), "RGBX;16B": (">u2", 4),
+                "RGBA;16L": ("<u2", 4), "RGBA;16B": (">u2", 4)}
+    STRIP = 256         # rows of a new level reduced at a time
+    SAMPLES = 1 << 20   # pixels looked at to find the black and white points
+
+    def __init__(self, pixels, tone=None):
+        self.pixels = pixels
+        (h, w, bands) = pixels.shape
+        self.size = (w, h)
+        self.mode = "L" if bands == 1 else "RGB"     # of the tone mapped regions, alpha is left out
+        self.nbytes = pixels.nbytes
+
+        if tone is None:
+            # Black and white points from the 0.1% darkest and brightest of an even sample of the pixels
+            step = max(1, int(math.sqrt(float(w) * h / self.SAMPLES)))
+            sample = numpy.asarray(pixels[::step, ::step, :min(bands, 3)])
+            (black, white) = numpy.percentile(sample, (0.1, 99.9))
+            tone = ToneMap(int(black), int(white))
+            logging.debug('HighBitImage: %d x %d x %d, black = %d, white = %d', w, h, bands, tone.black, tone.white)
+        self.tone = tone
+
+    def crop(self, box):
+
+        # Same as TiledImage.crop() (the area outside of the image is left black), tone mapped to 8 bits
+        (x0, y0, x1, y1) = box
+        (w, h) = self.size
+        bands = 1 if self.mode == "L" else 3
+        region = numpy.zeros((y1 - y0, x1 - x0, bands), numpy.uint8)
+
+        (cx0, cy0, cx1, cy1) = (max(0, x0), max(0, y0), min(w, x1), min(h, y1))
+        if cx1 > cx0 and cy1 > cy0:
+            region[cy0 - y0:cy1 - y0, cx0 - x0:cx1 - x0] = self.tone.lut()[self.pixels[cy0:cy1, cx0:cx1, :bands]]
+
+        return Image.fromarray(region[:, :, 0] if bands == 1 else region, self.mode)
+
+    def reduce(self):
+
+        # The next pyramid level, 16 bit means of 2 x 2 pixels, computed a strip at a time
+        (w, h) = self.size
+        bands = self.pixels.shape[2]
+        (fx, fy) = (2 if w > 1 else 1, 2 if h > 1 else 1)
+        (lw, lh) = (w // fx, h // fy)
+
+        level = numpy.empty((lh, lw, bands), numpy.uint16)
+        for y in xrange(0, lh, self.STRIP):
+            y1 = min(lh, y + self.STRIP)
+            block = self.pixels[y * fy:y1 * fy, :lw * fx].astype(numpy.uint32)
+            block = block.reshape(y1 - y, fy, lw, fx, bands).sum(axis=(1, 3))
+            level[y:y1] = (block + fx * fy // 2) // (fx * fy)
+
+        return HighBitImage(level, self.tone)
+
+def map_high_bit(image_file):
+
+    # The pixels of a 16 bit image as a (height, width, bands) array, None for other images.
+    # Uncompressed strips are memory mapped, as they are in the file when they follow each
+    # other, otherwise copied into a temporary file. Compressed grayscale is decoded.
+    image = Image.open(image_file)
+    if not image.tile:
+        return None
+    rawmodes = [args[0] if isinstance(args, tuple) else args for (decoder, extents, offset, args) in image.tile]
+    if rawmodes[0] not in HighBitImage.RAWMODES or len(set(rawmodes)) > 1:
+        return None
+
+    (w, h) = image.size
+    (dtype, bands) = HighBitImage.RAWMODES[rawmodes[0]]
+    row = w * bands * 2
+
+    strips = True
+    for (decoder, extents, offset, args) in image.tile:
+        if decoder != "raw" or extents[0] != 0 or extents[2] != w or not isinstance(args, tuple) \
+                or args[1] not in (0, row) or args[2] != 1:
+            strips = False
+
+    if not strips:
+        if bands != 1:
+            return None
+        logging.debug('map_high_bit: decoding %s', image_file)
+        return numpy.asarray(image).clip(0, 65535).astype(numpy.uint16).reshape(h, w, 1)
+
+    first = image.tile[0][2] - image.tile[0][1][1] * row
+    if all(offset == first + extents[1] * row for (decoder, extents, offset, args) in image.tile) \
+            and os.path.getsize(image_file) >= first + h * row:
+        logging.debug('map_high_bit: mapping %s directly', image_file)
+        return numpy.memmap(image_file, dtype, 'r', first, (h, w, bands))
+
+    logging.debug('map_high_bit: copying the strips of %s', image_file)
+    pixels = numpy.memmap(tempfile.TemporaryFile(), dtype, 'w+', 0, (h, w, bands))
+    f = open(image_file, 'rb')
+    try:
+        for (decoder, (x0, y0, x1, y1), offset, args) in image.tile:
+            f.seek(offset)
+            pixels[y0:y1] = numpy.fromfile(f, dtype, (y1 - y0) * w * bands).reshape(y1 - y0, w, bands)
+    finally:
+        f.close()
+    return pixels
+
+def open_raw_image(image_file, cache=None):
+
+    # The full resolution store of an image: a HighBitImage for 16 bit images, a TiledImage otherwise
+    pixels = map_high_bit(image_file)
+    if pixels is not None:
+        return HighBitImage(pixels)
+
+    return TiledImage(image_file, cache)
+
+
+####################################################################
+# Class: ImagePyramid
+# Keeps power-of-two reductions of the raw image (level 0 is the raw image,
+# level n is 1/2^n of it). Levels are only built the first time a zoom
+# factor needs them, each one from the level right above it (16 bit levels
+# are reduced by HighBitImage itself). With a TileCache (and a raw image
+# that's in it), a level that was built before is mapped from the cache, a
+# new one is saved there.
+####################################################################
+class ImagePyramid:
+
+    MARGIN = 8      # extra level pixels cropped around a region so the filter has context
+    STRIP = 128     # rows of a new level resampled at a time
+
+    def __init__(self, image, cache=None):
+
+        # Palette and bilevel images can only be resized with NEAREST, resample them in RGB instead
+        if image.mode in ("1", "P"):
+            image = image.convert("RGBA" if "transparency" in image.info else "RGB")
+
+        self.levels = [image]
+        self.lock = threading.Lock()
+        self.key = getattr(image, "key", None)
+        self.cache = cache if self.key else None
+
+    def level(self, n):
+
+        # Fill in the missing levels down to level n, one thread at a time (the render
+        # thread builds them, and the loader threads for the images they prepare)
+        with self.lock:
+            while len(self.levels) <= n:
+                if self.cache:
+                    cached = self.cache.find(self.key, len(self.levels))
+                    if cached:
+                        self.levels.append(TiledImage(cached))
+                        continue
+
+                prev = self.levels[-1]
+                if isinstance(prev, HighBitImage):
+                    self.levels.append(prev.reduce())
+                    continue
+
+                (w, h) = prev.size
+                (lw, lh) = (max(1, w // 2), max(1, h // 2))
+
+                # Reduce in horizontal strips, so that a tiled level 0 is never loaded as a whole
+                level = Image.new(prev.mode, (lw, lh))
+                fy = float(h) / lh
+                for y in xrange(0, lh, self.STRIP):
+                    y1 = min(lh, y + self.STRIP)
+                    level.paste(self.resample(prev, (0, y * fy, w, y1 * fy), (lw, y1 - y)), (0, y))
+
+                if self.cache:
+                    self.cache.store(self.key, len(self.levels), level)
+                self.levels.append(level)
+
+        return self.levels[n]
+
+    def nearest_level(self, scale):
+
+        # Find the smallest level that still has at least as many pixels as the
+        # zoom factor asks for, so the final resize never has to enlarge a level
+        (w, h) = self.levels[0].size
+        n = 0
+        while scale * (2 ** (n + 1)) <= 1.0 and (w >> (n + 1)) > 0 and (h >> (n + 1)) > 0:
+            n += 1
+
+        return n
+
+    def resample(self, source, box, size, resample=Image.ANTIALIAS):
+
+        # Crop the (fractional) box out of source with a small margin and resample only that area
+        (bx0, by0, bx1, by1) = box
+        (sw, sh) = source.size
+        cx0 = max(0, int(math.floor(bx0)) - self.MARGIN)
+        cy0 = max(0, int(math.floor(by0)) - self.MARGIN)
+        cx1 = min(sw, int(math.ceil(bx1)) + self.MARGIN)
+        cy1 = min(sh, int(math.ceil(by1)) + self.MARGIN)
+        tmp = source.crop((cx0, cy0, cx1, cy1))
+
+        return tmp.resize(size, resample, box=(bx0 - cx0, by0 - cy0, bx1 - cx0, by1 - cy0))
+
+    ####################################################################
+    # Function: render(), resample only the part of the zoomed image that is visible
+    # Args:  viewport       top left corner of the window in zoomed image coords
+    #        size           width, height of the window
+    #        scale          zoom factor (mux) in respect to the raw image
+    #        resample       PIL filter of the final resize, the levels are always built with ANTIALIAS
+    # Returns:  Image of the given size, the area outside of the image is left black
+    #           just like cropping a fully zoomed image would
+    ####################################################################
+    def render(self, viewport, size, scale, resample=Image.ANTIALIAS):
+
+        (vx, vy) = viewport
+        (w, h) = size
+        raw_w, raw_h = self.levels[0].size
+        zoomed_w, zoomed_h = int(raw_w * scale), int(raw_h * scale)
+
+        region = Image.new(self.levels[0].mode, (w, h))
+
+        # The part of the window actually covered by the zoomed image
+        dx0, dy0 = max(0, -vx), max(0, -vy)
+        dx1, dy1 = min(w, zoomed_w - vx), min(h, zoomed_h - vy)
+        if dx1 <= dx0 or dy1 <= dy0:
+            return region
+
+        # Map the covered window area back to the level, it's the to_raw() math
+        # with the level size in place of the raw image size
+        level = self.level(self.nearest_level(scale))
+        (lw, lh) = level.size
+        fx, fy = float(lw) / zoomed_w, float(lh) / zoomed_h
+        box = ((dx0 + vx) * fx, (dy0 + vy) * fy, (dx1 + vx) * fx, (dy1 + vy) * fy)
+
+        region.paste(self.resample(level, box, (dx1 - dx0, dy1 - dy0), resample), (dx0, dy0))
+
+        return region
+
+
+####################################################################
+# Class: TileCache
+# Decoded images and pyramid levels saved on disk, so opening an image again
+# (even after a restart) neither decodes nor resizes anything. Files are
+# keyed by the SHA-1 of the image file contents and the pyramid level, and
+# saved as binary PPM/PGM, which TiledImage maps directly. The least
+# recently used files are deleted once the folder is over budget bytes.
+####################################################################
+class TileCache:
+
+    MODES = ("L", "RGB")    # the modes PPM/PGM can hold, other images aren't cached
+    CHUNK = 1 << 20         # bytes of the image file hashed at a time
+
+    def __init__(self, folder, budget=2 << 30):
+        self.folder = folder
+        self.budget = budget
+        self.keys = {}          # (image file, size, mtime) -> content hash, so a file is hashed once
+        self.lock = threading.Lock()
+
+    def key(self, image_file):
+
+        stat = os.stat(image_file)
+        memo = (os.path.abspath(image_file), stat.st_size, stat.st_mtime)
+        key = self.keys.get(memo)
+        if key is None:
+            digest = hashlib.sha1()
+            f = open(image_file, 'rb')
+            try:
+                for chunk in iter(lambda: f.read(self.CHUNK), ""):
+                    digest.update(chunk)
+            finally:
+                f.close()
+            key = self.keys[memo] = digest.hexdigest()
+
+        return key
+
+    def path(self, key, level):
+        return os.path.join(self.folder, "tiles_%s_%d.pnm" % (key, level))
+
+    def find(self, key, level):
+
+        # The cached file of the level, or None. Its time is updated, that's what the LRU goes by
+        path = self.path(key, level)
+        with self.lock:
+            try:
+                os.utime(path, None)
+            except OSError:
+                return None
+
+        logging.debug('TileCache: found level %d of %s', level, key)
+        return path
+
+    def store(self, key, level, image):
+
+        # Save image (a PIL image or a TiledImage, in one of MODES) one strip at a time,
+        # under a temporary name first so a cache file is always complete
+        (w, h) = image.size
+        fd, tmp = tempfile.mkstemp(".tmp", "tiles_", self.folder)
+        out = os.fdopen(fd, 'wb')
+        try:
+            out.write("%s\n%d %d\n255\n" % ("P5" if image.mode == "L" else "P6", w, h))
+            for y in xrange(0, h, TiledImage.TILE_SIZE):
+                out.write(image.crop((0, y, w, min(h, y + TiledImage.TILE_SIZE))).tobytes())
+        except:
+            out.close()
+            os.remove(tmp)
+            raise
+        out.close()
+
+        path = self.path(key, level)
+        os.rename(tmp, path)
+        logging.debug('TileCache: saved level %d of %s', level, key)
+
+        self.trim(path)
+        return path
+
+    def trim(self, keep=None):
+        with self.lock:
+            trim_cache(self.folder, "tiles_", ".pnm", self.budget, keep)
+
+def trim_cache(folder, prefix, suffix, budget, keep=None):
+
+    # Delete the least recently used prefix*suffix files of folder until they fit in budget bytes,
+    # never keep (the file just stored, it's opened next even when it's over budget on its own).
+    # A file that's still mapped stays readable until it's closed, only the name goes away.
+    files = []
+    for name in os.listdir(folder):
+        if name.startswith(prefix) and name.endswith(suffix):
+            path = os.path.join(folder, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, path))
+
+    total = sum(size for (mtime, size, path) in files)
+    for (mtime, size, path) in sorted(files):
+        if total <= budget:
+            break
+        if path == keep:
+            continue
+        try:
+            os.remove(path)
+        except OSError:
+            continue
+        total -= size
+        logging.debug('trim_cache: dropped %s', path)
+
+
+####################################################################
+# Class: ImageLoader
+# Prepares images (see LoadImageApp.prepare_image) on a pool of worker
+# threads. Finished images are kept, most recently requested last, until
+# their decoded size goes over the memory budget; that's what makes
+# prefetching the next images of a folder possible.
+####################################################################
+class ImageLoader:
+
+    def __init__(self, prepare, workers=2, budget=512 << 20):
+        self.prepare = prepare
+        self.workers = workers
+        self.pool = None                # started with the first request
+        self.budget = budget
+        self.jobs = OrderedDict()       # image file -> AsyncResult, least recently requested first
+
+    def request(self, image_file):
+
+        # Start preparing the image (unless it's done or under way), the AsyncResult
+        # returns (raw_image, pyramid, zoomcycle, first view)
+        job = self.jobs.pop(image_file, None)
+        if job is None:
+            if self.pool is None:
+                from multiprocessing.pool import ThreadPool
+                self.pool = ThreadPool(self.workers)
+
+            logging.debug('ImageLoader: preparing %s', image_file)
+            job = self.pool.apply_async(self.prepare, (image_file,))
+
+        self.jobs[image_file] = job
+        self.trim()
+        return job
+
+    def forget(self, image_file):
+        self.jobs.pop(image_file, None)
+
+    def close(self):
+
+        # Drop the images not started yet and wait for the ones being prepared, so no
+        # worker thread is still decoding while the interpreter shuts down
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
+        self.jobs.clear()
+
+    def trim(self):
+
+        # Forget the least recently requested images over the budget, never the latest one
+        # (jobs still running can't be stopped, they are only forgotten)
+        total = 0
+        for (image_file, job) in self.jobs.items()[:-1]:
+            if job.ready() and job.successful():
+                total += job.get()[0].nbytes
+
+        for (image_file, job) in self.jobs.items()[:-1]:
+            if total <= self.budget:
+                break
+            if job.ready():
+                if job.successful():
+                    total -= job.get()[0].nbytes
+                del self.jobs[image_file]
+                logging.debug('ImageLoader: dropped %s', image_file)
+
+
+####################################################################
+# Class: RenderWorker
+# Renders regions of an ImagePyramid on a thread of its own, so the
+# resampling (PIL lets go of the GIL while it resizes) never holds up the
+# Tk thread. Requests are numbered by generation and only the latest one is
+# kept: a request that hasn't started when a newer one comes in is dropped.
+# The Tk thread polls for the finished frame with collect().
+####################################################################
+class RenderWorker:
+
+    def __init__(self):
+        self.generation = 0         # of the latest request
+        self.cancelled = 0          # frames up to this generation are dropped, see cancel()
+        self.request = None         # (generation, pyramid, viewport, size, scale, filter) waiting to be rendered
+        self.frame = None           # request + (rendered image,), finished and not collected yet
+        self.rendering = False
+        self.closed = False
+        self.cond = threading.Condition()
+        self.thread = None          # started with the first request
+
+    def submit(self, pyramid, viewport, size, scale, resample=Image.ANTIALIAS):
+
+        with self.cond:
+            self.generation += 1
+            if self.request is not None:
+                logging.debug('RenderWorker: frame %d dropped for frame %d', self.request[0], self.generation)
+            self.request = (self.generation, pyramid, viewport, size, scale, resample)
+
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name="RenderWorker")
+                self.thread.daemon = True
+                self.thread.start()
+            self.cond.notify()
+            return self.generation
+
+    def cancel(self):
+
+        # Drop the waiting request and the frames of the requests made so far, as when another image is opened
+        with self.cond:
+            self.request = None
+            self.frame = None
+            self.cancelled = self.generation
+
+    def pending(self):
+
+        # True until the frame of the latest request has been collected
+        with self.cond:
+            return self.rendering or self.request is not None or self.frame is not None
+
+    def collect(self):
+
+        with self.cond:
+            frame = self.frame
+            self.frame = None
+            return frame
+
+    def close(self):
+
+        # Let the frame being rendered finish and stop the thread
+        with self.cond:
+            self.closed = True
+            self.request = None
+            self.cond.notify()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def run(self):
+
+        while True:
+            with self.cond:
+                while self.request is None and not self.closed:
+                    self.cond.wait()
+                if self.closed:
+                    return
+                request = self.request
+                self.request = None
+                self.rendering = True
+
+            (generation, pyramid, viewport, size, scale, resample) = request
+            try:
+                image = pyramid.render(viewport, size, scale, resample)
+            except Exception:
+                logging.exception('RenderWorker: frame %d failed', generation)
+                image = None
+
+            with self.cond:
+                self.rendering = False
+                if image is not None and generation > self.cancelled:
+                    self.frame = request + (image,)
+
+
+####################################################################
+# Class: DotIndex
+# Uniform grid over the raw image coordinates of the dots (by dot ID), so
+# the dots in a rectangle can be found without looking at every dot. The
+# exact test against the rectangle is left to DotStore.
+####################################################################
+class DotIndex:
+
+    CELL = 64       # raw image pixels per side of a grid cell
+
+    def __init__(self):
+        self.cells = {}     # (column, row) of a cell -> list of the IDs of the dots in it
+
+    def cell(self, x, y):
+        return (int(x) // self.CELL, int(y) // self.CELL)
+
+    def clear(self):
+        self.cells.clear()
+
+    def add(self, key, x, y):
+        self.cells.setdefault(self.cell(x, y), []).append(key)
+
+    def add_many(self, keys, xs, ys):
+
+        # Add a batch of dots, sorted by cell so that each cell is only looked up once
+        if len(keys) == 1:
+            return self.add(int(keys[0]), xs[0], ys[0])
+
+        columns = numpy.asarray(xs, dtype=numpy.int64) // self.CELL
+        rows = numpy.asarray(ys, dtype=numpy.int64) // self.CELL
+        order = numpy.lexsort((rows, columns))
+        (columns, rows, keys) = (columns[order], rows[order], numpy.asarray(keys)[order])
+
+        starts = numpy.flatnonzero((numpy.diff(columns) != 0) | (numpy.diff(rows) != 0)) + 1
+        starts = [0] + starts.tolist()
+        ends = starts[1:] + [len(keys)]
+        for (start, end) in zip(starts, ends):
+            if start < end:
+                cell = (int(columns[start]), int(rows[start]))
+                self.cells.setdefault(cell, []).extend(keys[start:end].tolist())
+
+    def candidates(self, x0, y0, x1, y1):
+
+        # IDs of all the dots in the cells touched by the rectangle
+        (c0, r0) = self.cell(math.floor(x0), math.floor(y0))
+        (c1, r1) = self.cell(math.floor(x1), math.floor(y1))
+
+        # A rectangle much larger than the image has more cells than there are non empty ones
+        if (c1 - c0 + 1) * (r1 - r0 + 1) > len(self.cells):
+            keys = [k for k in self.cells if c0 <= k[0] <= c1 and r0 <= k[1] <= r1]
+        else:
+            keys = [(c, r) for c in xrange(c0, c1 + 1) for r in xrange(r0, r1 + 1) if (c, r) in self.cells]
+
+        found = []
+        for key in keys:
+            found.extend(self.cells[key])
+
+        return found
+
+    def remove(self, keys, xs, ys):
+
+        # Remove a batch of dots, grouped by cell so that each cell is only filtered once
+        by_cell = {}
+        for (key, x, y) in zip(keys, xs, ys):
+            by_cell.setdefault(self.cell(x, y), set()).add(key)
+
+        for cell, removed in by_cell.items():
+            kept = [key for key in self.cells.get(cell, ()) if key not in removed]
+            if kept:
+                self.cells[cell] = kept
+            else:
+                self.cells.pop(cell, None)
+
+
+####################################################################
+# Class: DotStore
+# The saved dots, kept as columns of NumPy arrays: X,Y in raw image coords
+# plus Horizon Elevation and Azimuth, which are NaN until calculated.
+# Every dot gets an integer ID that never changes and is never reused,
+# adding or deleting a dot by ID is O(1). Deleting leaves a hole that is
+# squeezed out once there are more holes than dots, so the dots always
+# stay in the order they were added. With a SessionJournal attached, every
+# change is also appended to the journal.
+####################################################################
+class DotStore:
+
+    NOT_COMPUTED = float("nan")
+    journal = None
+
+    def __init__(self):
+        self.index = DotIndex()
+        self.clear()
+
+    def clear(self, capacity=1024):
+
+        self.x = numpy.zeros(capacity, dtype=numpy.int32)
+        self.y = numpy.zeros(capacity, dtype=numpy.int32)
+        self.horizon = numpy.zeros(capacity)
+        self.azimuth = numpy.zeros(capacity)
+        self.id = numpy.zeros(capacity, dtype=numpy.int64)
+        self.alive = numpy.zeros(capacity, dtype=bool)
+        self.slot_of = numpy.zeros(capacity, dtype=numpy.int64)    # dot ID -> slot, -1 once deleted
+
+        self.used = 0           # slots taken, holes included
+        self.count = 0          # dots
+        self.next_id = 0
+        self.index.clear()
+
+        if self.journal:
+            self.journal.dots_cleared()
+
+    def load(self, ids, xs, ys, horizons, azimuths, next_id):
+
+        # Replace the dots by saved columns (see read_session()), their IDs included
+        n = len(ids)
+        journal, self.journal = self.journal, None
+        self.clear(max(n, 1024))
+        self.journal = journal
+
+        self.x[:n] = xs
+        self.y[:n] = ys
+        self.horizon[:n] = horizons
+        self.azimuth[:n] = azimuths
+        self.id[:n] = ids
+        self.alive[:n] = True
+
+        self.slot_of = numpy.empty(max(next_id, 1024), dtype=numpy.int64)
+        self.slot_of[:] = -1
+        self.slot_of[self.id[:n]] = numpy.arange(n)
+
+        self.index.add_many(self.id[:n], self.x[:n], self.y[:n])
+
+        self.used = n
+        self.count = n
+        self.next_id = next_id
+
+    def __len__(self):
+        return self.count
+
+    def grow(self, n):
+
+        # Make room for n more dots, the arrays double in size so adding stays O(1)
+        if self.used + n > len(self.x):
+            capacity = max(self.used + n, 2 * len(self.x))
+            for name in ("x", "y", "horizon", "azimuth", "id", "alive"):
+                old = getattr(self, name)
+                new = numpy.zeros(capacity, dtype=old.dtype)
+                new[:self.used] = old[:self.used]
+                setattr(self, name, new)
+
+        if self.next_id + n > len(self.slot_of):
+            new = numpy.zeros(max(self.next_id + n, 2 * len(self.slot_of)), dtype=numpy.int64)
+            new[:self.next_id] = self.slot_of[:self.next_id]
+            self.slot_of = new
+
+    def add(self, x, y, horizon=NOT_COMPUTED, azimuth=NOT_COMPUTED):
+        return int(self.add_many([x], [y], [horizon], [azimuth])[0])
+
+    def add_many(self, xs, ys, horizons=None, azimuths=None):
+
+        n = len(xs)
+        self.grow(n)
+
+        slots = slice(self.used, self.used + n)
+        ids = numpy.arange(self.next_id, self.next_id + n, dtype=numpy.int64)
+
+        self.x[slots] = xs
+        self.y[slots] = ys
+        self.horizon[slots] = self.NOT_COMPUTED if horizons is None else horizons
+        self.azimuth[slots] = self.NOT_COMPUTED if azimuths is None else azimuths
+        self.id[slots] = ids
+        self.alive[slots] = True
+        self.slot_of[ids] = numpy.arange(self.used, self.used + n)
+        self.index.add_many(ids, self.x[slots], self.y[slots])
+
+        self.used += n
+        self.count += n
+        self.next_id += n
+
+        if self.journal:
+            self.journal.dots_added(ids, self.x[slots], self.y[slots], self.horizon[slots], self.azimuth[slots])
+
+        return ids
+
+    def delete(self, dot_id):
+        self.delete_many([dot_id])
+
+    def delete_many(self, ids):
+
+        ids = numpy.unique(numpy.asarray(ids, dtype=numpy.int64))
+        ids = ids[self.slot_of[ids] >= 0]
+        slots = self.slot_of[ids]
+
+        self.index.remove(ids.tolist(), self.x[slots].tolist(), self.y[slots].tolist())
+        self.alive[slots] = False
+        self.slot_of[ids] = -1
+        self.count -= len(ids)
+
+        if self.journal:
+            self.journal.dots_deleted(ids)
+
+        if self.used - self.count > self.count:
+            self.compact()
+
+    def compact(self):
+
+        # Squeeze out the holes left by deleted dots, keeping the order of the dots
+        live = numpy.flatnonzero(self.alive[:self.used])
+        n = len(live)
+
+        for name in ("x", "y", "horizon", "azimuth", "id"):
+            column = getattr(self, name)
+            column[:n] = column[live]
+
+        self.alive[:n] = True
+        self.alive[n:self.used] = False
+        self.slot_of[self.id[:n]] = numpy.arange(n)
+        self.used = n
+
+    def columns(self):
+
+        # IDs, X, Y, Horizon and Azimuth arrays of all the dots in the order they were added.
+        # These are views into the store, only good until the next change.
+        if self.used != self.count:
+            self.compact()
+
+        n = self.count
+        return (self.id[:n], self.x[:n], self.y[:n], self.horizon[:n], self.azimuth[:n])
+
+    def coords(self, ids):
+        slots = self.slot_of[numpy.asarray(ids, dtype=numpy.int64)]
+        return (self.x[slots], self.y[slots])
+
+    def set_computed(self, horizons, azimuths):
+
+        # Horizon Elevation and Azimuth of every dot, in the order of columns()
+        n = len(self.columns()[0])
+        self.horizon[:n] = horizons
+        self.azimuth[:n] = azimuths
+
+    def query(self, x0, y0, x1, y1):
+
+        # IDs of the dots with x0 <= x <= x1 and y0 <= y <= y1
+        ids = numpy.array(self.index.candidates(x0, y0, x1, y1), dtype=numpy.int64)
+        (xs, ys) = self.coords(ids)
+
+        return ids[(xs >= x0) & (xs <= x1) & (ys >= y0) & (ys <= y1)]
+
+    def rows(self):
+
+        # The dots as X,Y rows, or X,Y,Horizon,Azimuth rows once those are calculated
+        (ids, xs, ys, horizons, azimuths) = self.columns()
+
+        for (x, y, horizon, azimuth) in zip(xs.tolist(), ys.tolist(), horizons.tolist(), azimuths.tolist()):
+            if horizon != horizon:      # NaN, not calculated
+                yield (x, y)
+            else:
+                yield (x, y, horizon, azimuth)
+
+
+####################################################################
+# Geometry on NumPy arrays: each function takes whole arrays of x and y
+# coordinates (plain numbers work too), so a large set of dots is done in
+# one pass. The LoadImageApp methods of the same names are per point
+# wrappers around these.
+####################################################################
+
+CAMERA = 185        # field of view of the fisheye lens, in degrees
+
+def to_raw_array(xs, ys, viewport, scale):
+
+    # Translate window coordinates to raw_image coordinates
+    (vx, vy) = viewport
+    return ((numpy.asarray(xs) + vx) / scale).astype(int), ((numpy.asarray(ys) + vy) / scale).astype(int)
+
+def to_window_array(xs, ys, viewport, scale):
+
+    # Translate raw_image coordinates to window coordinates
+    (vx, vy) = viewport
+    return (numpy.asarray(xs) * scale).astype(int) - vx, (numpy.asarray(ys) * scale).astype(int) - vy
+
+def find_angle_array(C, P2, xs, ys):
+
+    # Angle between P2 and each point around C, in range of 0 to 360 in clockwise direction
+    angle = numpy.degrees(math.atan2(P2[1]-C[1], P2[0]-C[0]) - numpy.arctan2(numpy.asarray(ys) - C[1], numpy.asarray(xs) - C[0]))
+    return numpy.where(angle <= 0, numpy.fabs(angle), 360 - angle)
+
+def dot_radius_array(C, xs, ys):
+
+    # (x-center.x)2 + (y-center.y)2 = r2
+    dx = numpy.asarray(xs) - C[0]
+    dy = numpy.asarray(ys) - C[1]
+    return numpy.sqrt(dx * dx + dy * dy)
+
+def find_horizon_array(dot_radius, grid_radius):
+
+    # Horizon elevation falls linearly from the zenith at the center to 0 at the grid radius,
+    # the half angle is the integer CAMERA/2 the results have always been based on
+    half_camera = CAMERA // 2
+    return half_camera - ((numpy.asarray(dot_radius, dtype=float) / grid_radius) * half_camera)
+
+def calculate_dots(center, radius, azimuth_coords, xs, ys):
+
+    # Horizon Elevation and Azimuth lists of the dots, rounded to 5 places the way they are saved
+    azimuths = find_angle_array(center, azimuth_coords, xs, ys)
+    horizons = find_horizon_array(dot_radius_array(center, xs, ys), radius)
+
+    return ([round(horizon,5) for horizon in horizons.tolist()], [round(azimuth,5) for azimuth in azimuths.tolist()])
+
+####################################################################
+# Class: HorizonLookup
+# Horizon Elevation of every pixel of an image, for one grid (center, radius).
+# It's kept as int32 in 1/100000, which is exactly what rounding to 5 places
+# (as the dots are saved) gives. The azimuth isn't kept, it turns with the
+# field azimuth and is one angle per point. With a cache folder, the raster
+# is built into a file there and memory mapped the next time the same grid
+# is used, by any image of the same size; the least recently used files go
+# once the folder is over cache_bytes.
+####################################################################
+class HorizonLookup:
+
+    SCALE = 100000
+    STRIP = 256        # rows computed at a time, to keep the temporary arrays small
+
+    def __init__(self, size, center, radius, cache_dir=None, cache_bytes=2 << 30):
+        self.key = (tuple(size), tuple(center), radius)
+        self.size = size
+        (w, h) = size
+
+        path = None
+        if cache_dir:
+            path = os.path.join(cache_dir, "lookup_%s.npy" % hashlib.sha1(repr(self.key)).hexdigest())
+            try:
+                os.utime(path, None)    # that's what the LRU goes by
+                horizon = numpy.load(path, mmap_mode='r')
+                if horizon.shape != (h, w) or horizon.dtype != numpy.int32:
+                    raise ValueError("it holds a %s array of %s" % (horizon.dtype, horizon.shape))
+                logging.debug('HorizonLookup: mapping %s', path)
+                self.horizon = horizon
+                return
+            except (OSError, IOError):
+                pass
+            except ValueError, e:
+                # cut short, or not a lookup of this size: it's dropped and built again
+                logging.warning('HorizonLookup: dropping %s, %s', path, e)
+                horizon = None
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+
+        logging.debug('HorizonLookup: building %d x %d lookup for center = %s, radius = %d', w, h, center, radius)
+        if path:
+            # built into a temporary file first, so a cache file is always complete
+            fd, tmp = tempfile.mkstemp(".tmp", "lookup_", cache_dir)
+            os.close(fd)
+            try:
+                self.horizon = numpy.lib.format.open_memmap(tmp, 'w+', numpy.int32, (h, w))
+                self.fill(center, radius)
+                self.horizon.flush()
+            except:
+                self.horizon = None
+                os.remove(tmp)
+                raise
+            os.rename(tmp, path)
+            trim_cache(cache_dir, "lookup_", ".npy", cache_bytes, path)
+        else:
+            self.horizon = numpy.empty((h, w), numpy.int32)
+            self.fill(center, radius)
+
+    def fill(self, center, radius):
+
+        (h, w) = self.horizon.shape
+        xs = numpy.arange(w)[numpy.newaxis, :]
+        for y in xrange(0, h, self.STRIP):
+            ys = numpy.arange(y, min(h, y + self.STRIP))[:, numpy.newaxis]
+            self.horizon[y:y + len(ys)] = self.fixed(find_horizon_array(dot_radius_array(center, xs, ys), radius))
+
+    def fixed(self, values):
+
+        # values in 1/SCALE, rounded the way round(value, 5) does. numpy rounds halves
+        # to even (and value*SCALE isn't exact), so round() decides close to the halves
+        scaled = values * self.SCALE
+        result = numpy.round(scaled)
+        halves = numpy.flatnonzero(numpy.abs(scaled - numpy.floor(scaled) - 0.5) < 1e-6)
+        for i in halves:
+            result.flat[i] = round(round(float(values.flat[i]), 5) * self.SCALE)
+
+        return result.astype(numpy.int32)
+
+    def values(self, center, radius, azimuth_coords, xs, ys):
+
+        # Horizon Elevation and Azimuth lists of the points, as calculate_dots() gives them. The
+        # points outside of the image are calculated, the grid is passed again for them.
+        xs = numpy.asarray(xs, dtype=numpy.intp)
+        ys = numpy.asarray(ys, dtype=numpy.intp)
+        (w, h) = self.size
+
+        inside = (xs >= 0) & (xs < w) & (ys >= 0) & (ys < h)
+        horizons = numpy.empty(len(xs))
+        horizons[inside] = self.horizon[ys[inside], xs[inside]] / float(self.SCALE)
+
+        outside = ~inside
+        if outside.any():
+            horizons[outside] = calculate_dots(center, radius, azimuth_coords, xs[outside], ys[outside])[0]
+
+        azimuths = find_angle_array(center, azimuth_coords, xs, ys)
+        return (horizons.tolist(), [round(azimuth,5) for azimuth in azimuths.tolist()])
+
+def update_dots(dots, center, radius, azimuth_coords, lookup=None):
+
+    # Horizon Elevation and Azimuth of all the dots of a DotStore in one pass, looked up
+    # when lookup (a HorizonLookup) is of the same grid
+    (ids, xs, ys, horizons, azimuths) = dots.columns()
+
+    if lookup and lookup.key[1:] == (tuple(center), radius):
+        (horizons, azimuths) = lookup.values(center, radius, azimuth_coords, xs, ys)
+    else:
+        (horizons, azimuths) = calculate_dots(center, radius, azimuth_coords, xs, ys)
+    dots.set_computed(horizons, azimuths)
+
+def simplify_line(points, tolerance):
+
+    # Ramer-Douglas-Peucker: the fewest points of the line that keep each dropped point within
+    # tolerance of the line, the ends are always kept. points is an (n, 2) array.
+    points = numpy.asarray(points)
+    keep = numpy.zeros(len(points), dtype=bool)
+    keep[0] = keep[-1] = True
+
+    spans = [(0, len(points) - 1)]
+    while spans:
+        (first, last) = spans.pop()
+        if last - first < 2:
+            continue
+
+        start = points[first].astype(float)
+        (dx, dy) = points[last] - start
+        rest = points[first+1:last] - start
+
+        # distance of the points in between to the chord (or to its start, if both ends are the same)
+        length = math.hypot(dx, dy)
+        if length:
+            distance = numpy.fabs(dx * rest[:, 1] - dy * rest[:, 0]) / length
+        else:
+            distance = numpy.hypot(rest[:, 0], rest[:, 1])
+
+        i = int(numpy.argmax(distance))
+        if distance[i] > tolerance:
+            i += first + 1
+            keep[i] = True
+            spans.append((first, i))
+            spans.append((i, last))
+
+    return points[keep]
+
+def zoom_factors(min_zoom, max_zoom):
+
+    # The scaling/zoom table (mux): zoomcycle -> zoom factor, 10% per zoomcycle
+    mux = {0 : 1.0}
+    for n in range(1,max_zoom+1,1):
+        mux[n] = round(mux[n-1] * 1.1, 5)
+
+    for n in range(-1, min_zoom-1, -1):
+        mux[n] = round(mux[n+1] * 0.9, 5)
+
+    return mux
+
+def fit_zoom(size, mux, min_zoom):
+
+    # The zoomcycle an image is opened with: if it's larger than 1000 pixels, zoom out until
+    # it fits in 800 x 600, the raw image (and so the dots) stays in full resolution
+    (width, height) = size
+    zoomcycle = 0
+    while (width > 1000 or height > 1000) and zoomcycle > min_zoom and \
+            (width * mux[zoomcycle] > 800 or height * mux[zoomcycle] > 600):
+        zoomcycle -= 1
+
+    return zoomcycle
+
+def default_grid(size):
+
+    # Default grid center (middle of the image) and radius (half the diagonal) for an image size
+    center = (int(size[0]/2), int(size[1]/2))
+    return center, int(math.sqrt(center[0] * center[0] + center[1] * center[1]))
+
+def field_azimuth_end(center, radius, azimuth, anchor):
+
+    # End point of the field azimuth line drawn from center to radius, azimuth is in degrees
+    # clockwise from the anchor point, whose angle is found from a standard circle (1,0) 0 degrees.
+    # Returns None if the angle is out of range.
+    anchor_angle = float(find_angle_array(center, (center[0]+radius, center[1]), anchor[0], anchor[1]))
+    adjusted_azimuth = anchor_angle + azimuth
+
+    if adjusted_azimuth > 360:
+        adjusted_azimuth = adjusted_azimuth - 360
+
+    if adjusted_azimuth < 0 or adjusted_azimuth > 360:
+        return None
+
+    rX = center[0] + int(radius * math.cos(math.radians(adjusted_azimuth)))
+    rY = center[1] + int(radius * math.sin(math.radians(adjusted_azimuth)))
+    return (rX, rY)
+
+def iter_dots_csv(csv_file, chunk=5000):
+
+    # Reads the dots of a CSV file (the first row is the header) a chunk of rows at a time,
+    # yields (X list, Y list, fraction of the file read so far)
+    size = float(os.path.getsize(csv_file)) or 1.0
+
+    f = open(csv_file,'rt')
+    try:
+        reader = csv.reader(f)
+        logging.debug('Header Info: %s', next(reader, None))
+
+        xs, ys = [], []
+        for row in reader:
+            if not row:
+                continue
+
+            xs.append(int(row[0]))
+            ys.append(int(row[1]))
+
+            if len(xs) >= chunk:
+                yield xs, ys, min(1.0, f.tell() / size)
+                xs, ys = [], []
+
+        yield xs, ys, 1.0
+    finally:
+        f.close()
+
+def read_dots_csv(csv_file):
+
+    # X,Y lists of all the dots in a CSV file
+    xs, ys = [], []
+    for (chunk_xs, chunk_ys, done) in iter_dots_csv(csv_file):
+        xs.extend(chunk_xs)
+        ys.extend(chunk_ys)
+
+    return xs, ys
+
+def write_dots_csv(f, rows):
+
+    # The X, Y, Horizon, Azimuth rows of the dots to the open file f, with the header
+    writer = csv.writer(f)
+    writer.writerow(('X', 'Y', 'Horizon', 'Azimuth'))
+    writer.writerows(rows)
+
+
+####################################################################
+# Sessions: the dots, the grid and the field azimuth of an image, saved in a
+# binary file that loads with the dot columns memory mapped:
+#     header (SESSION_HEADER), image file name (relative to the session file),
+#     then the ID, Horizon, Azimuth, X and Y columns of the dots, 8 byte aligned
+# The changes since the session was saved go to an append-only journal next
+# to it (see SessionJournal), replayed when the session is opened. The stamp
+# in the header ties a session file to its journal, a journal left over from
+# before the last save has another stamp and is ignored.
+####################################################################
+
+SESSION_MAGIC = "EVSESS\x00\x01"
+SESSION_HEADER = struct.Struct('<8sqqqiiiiiidiiI')  # magic, stamp, count, next ID, center, radius, grid shown,
+                                                     # anchor, field azimuth, field azimuth end, name length
+SESSION_COLUMNS = [("id", numpy.int64), ("horizon", numpy.float64), ("azimuth", numpy.float64),
+                   ("x", numpy.int32), ("y", numpy.int32)]
+
+def write_session(session_file, image_file, grid, columns, next_id, lines=()):
+
+    # grid is (center, radius, grid shown, anchor, field azimuth, field azimuth end),
+    # columns are the (IDs, X, Y, Horizon, Azimuth) arrays of DotStore.columns(),
+    # lines the (n, 2) point arrays of the lines drawn.
+    # Written under a temporary name first, so the old session stays whole until the new one is.
+    # Returns the stamp of the new session.
+    (center, radius, shown, anchor, field_azimuth, azimuth_end) = grid
+    (ids, xs, ys, horizons, azimuths) = columns
+    stamp = struct.unpack('<q', os.urandom(8))[0]
+
+    name = os.path.relpath(os.path.abspath(image_file), os.path.dirname(os.path.abspath(session_file))).encode('utf-8')
+    header = SESSION_HEADER.pack(SESSION_MAGIC, stamp, len(ids), next_id, center[0], center[1], radius, int(bool(shown)),
+                                 anchor[0], anchor[1], field_azimuth, azimuth_end[0], azimuth_end[1], len(name))
+
+    tmp = session_file + ".tmp"
+    f = open(tmp, 'wb')
+    try:
+        f.write(header + name)
+        f.write("\x00" * (-(len(header) + len(name)) % 8))
+
+        data = {"id": ids, "horizon": horizons, "azimuth": azimuths, "x": xs, "y": ys}
+        for (column, dtype) in SESSION_COLUMNS:
+            numpy.ascontiguousarray(data[column], dtype=dtype).tofile(f)
+
+        # the lines: their count, their point counts, then the X,Y of all the points
+        numpy.array([len(lines)] + [len(line) for line in lines], dtype=numpy.int64).tofile(f)
+        for line in lines:
+            numpy.ascontiguousarray(line, dtype=numpy.int32).tofile(f)
+    finally:
+        f.close()
+    os.rename(tmp, session_file)
+
+    return stamp
+
+def read_session(session_file):
+
+    # Returns (stamp, image file, grid, next ID, (IDs, X, Y, Horizon, Azimuth), lines) with
+    # the columns memory mapped, read only
+    f = open(session_file, 'rb')
+    try:
+        header = f.read(SESSION_HEADER.size)
+        if len(header) < SESSION_HEADER.size or not header.startswith(SESSION_MAGIC):
+            raise ValueError("not a session file")
+
+        (magic, stamp, count, next_id, cx, cy, radius, shown, ax, ay,
+         field_azimuth, ex, ey, name_length) = SESSION_HEADER.unpack(header)
+        name = f.read(name_length).decode('utf-8')
+    finally:
+        f.close()
+
+    image_file = os.path.join(os.path.dirname(os.path.abspath(session_file)), name)
+    grid = ((cx, cy), radius, bool(shown), (ax, ay), field_azimuth, (ex, ey))
+
+    offset = SESSION_HEADER.size + name_length
+    offset += -offset % 8
+    data = {}
+    for (column, dtype) in SESSION_COLUMNS:
+        if count:
+            data[column] = numpy.memmap(session_file, dtype=dtype, mode='r', offset=offset, shape=(count,))
+        else:
+            data[column] = numpy.zeros(0, dtype=dtype)
+        offset += count * numpy.dtype(dtype).itemsize
+
+    f = open(session_file, 'rb')
+    try:
+        f.seek(offset)
+        line_count = int(numpy.fromfile(f, dtype=numpy.int64, count=1)[0])
+        lengths = numpy.fromfile(f, dtype=numpy.int64, count=line_count).tolist()
+        lines = [numpy.fromfile(f, dtype=numpy.int32, count=2 * n).reshape(n, 2) for n in lengths]
+    finally:
+        f.close()
+
+    return stamp, image_file, grid, next_id, (data["id"], data["x"], data["y"], data["horizon"], data["azimuth"]), lines
+
+####################################################################
+# Class: SessionJournal
+# Append-only log of the changes made to a session since it was saved. Every
+# change is one or more fixed size records (RECORD), appended and flushed
+# right away, so adding or deleting a dot costs one small write. The first
+# record carries the stamp of the session file the journal belongs to.
+####################################################################
+class SessionJournal:
+
+    STAMP, ADDED, DELETED, CLEARED, GRID, AZIMUTH, CALCULATED, LINE = range(8)
+
+    # op, then: dot ID (stamp, radius for GRID, line number for LINE), X,Y (center for GRID,
+    # anchor for AZIMUTH, a point for LINE), Horizon and Azimuth (grid shown for GRID, field
+    # azimuth for AZIMUTH). A line is one LINE record per point.
+    RECORD = numpy.dtype([("op", "u1"), ("id", "<i8"), ("x", "<i4"), ("y", "<i4"), ("h", "<f8"), ("a", "<f8")])
+
+    def __init__(self, journal_file, stamp=None, length=None):
+
+        # A stamp starts a new journal, otherwise the records are appended to the existing one,
+        # after its first length bytes if given (what's past them is cut off)
+        if stamp is None:
+            self.file = open(journal_file, 'ab')
+            if length is not None:
+                self.file.truncate(length)
+        else:
+            self.file = open(journal_file, 'wb')
+            record = self.records(self.STAMP, 1)
+            record["id"] = stamp
+            self.append(record)
+
+    def records(self, op, n):
+        records = numpy.zeros(n, dtype=self.RECORD)
+        records["op"] = op
+        return records
+
+    def append(self, records):
+        self.file.write(records.tostring())
+        self.file.flush()
+
+    def dots_added(self, ids, xs, ys, horizons, azimuths):
+        records = self.records(self.ADDED, len(ids))
+        (records["id"], records["x"], records["y"], records["h"], records["a"]) = (ids, xs, ys, horizons, azimuths)
+        self.append(records)
+
+    def dots_deleted(self, ids):
+        records = self.records(self.DELETED, len(ids))
+        records["id"] = ids
+        self.append(records)
+
+    def dots_cleared(self):
+        self.append(self.records(self.CLEARED, 1))
+
+    def grid(self, center, radius, shown):
+        record = self.records(self.GRID, 1)
+        (record["id"], record["x"], record["y"], record["h"]) = (radius, center[0], center[1], bool(shown))
+        self.append(record)
+
+    def azimuth(self, anchor, field_azimuth):
+        record = self.records(self.AZIMUTH, 1)
+        (record["x"], record["y"], record["h"]) = (anchor[0], anchor[1], field_azimuth)
+        self.append(record)
+
+    def calculated(self):
+        self.append(self.records(self.CALCULATED, 1))
+
+    def line_added(self, number, points):
+        records = self.records(self.LINE, len(points))
+        (records["id"], records["x"], records["y"]) = (number, points[:, 0], points[:, 1])
+        self.append(records)
+
+    def close(self):
+        self.file.close()
+
+def read_journal(journal_file, stamp):
+
+    # Returns (records, length): the records of the journal of the session with that stamp, and
+    # the bytes of the journal they fill, stamp included. A record cut short by a crash is left
+    # out (and out of length). With no journal, or one from another save, there are no records
+    # and length is None.
+    if not os.path.isfile(journal_file):
+        return numpy.zeros(0, dtype=SessionJournal.RECORD), None
+
+    f = open(journal_file, 'rb')
+    try:
+        data = f.read()
+    finally:
+        f.close()
+
+    size = SessionJournal.RECORD.itemsize
+    length = len(data) // size * size
+    records = numpy.frombuffer(data[:length], dtype=SessionJournal.RECORD)
+    if not len(records) or records[0]["op"] != SessionJournal.STAMP or records[0]["id"] != stamp:
+        logging.warning('Ignoring %s, it is not the journal of the saved session', journal_file)
+        return numpy.zeros(0, dtype=SessionJournal.RECORD), None
+
+    if length < len(data):
+        logging.warning('Session journal %s ends with a record cut short, it is left out', journal_file)
+    return records[1:], length
+
+def open_journal(journal_file, stamp):
+
+    # Returns (records, SessionJournal): the changes journaled since the session with that stamp
+    # was saved, and the journal to go on with. A record cut short is cut off, so the next ones
+    # line up; a missing journal, or one from another save, is started again.
+    (records, length) = read_journal(journal_file, stamp)
+    if length is None:
+        return records, SessionJournal(journal_file, stamp)
+
+    return records, SessionJournal(journal_file, length=length)
+
+def replay_journal(session, records):
+
+    # Apply the records to session (a LoadImageApp or a ServedSession: its dots, lines, grid and
+    # field azimuth). Runs of records of the same kind are applied together
+    ops = records["op"]
+    starts = [0] + (numpy.flatnonzero(numpy.diff(ops)) + 1).tolist()
+    ends = starts[1:] + [len(records)]
+
+    for (start, end) in zip(starts, ends):
+        if start == end:
+            continue
+        run = records[start:end]
+        op = run["op"][0]
+        last = run[-1]
+
+        if op == SessionJournal.ADDED:
+            ids = session.dots.add_many(run["x"], run["y"], run["h"], run["a"])
+            if not numpy.array_equal(ids, run["id"]):
+                logging.warning('Session journal: dot IDs out of step')
+        elif op == SessionJournal.DELETED:
+            session.dots.delete_many(run["id"])
+        elif op == SessionJournal.CLEARED:
+            session.dots.clear()
+        elif op == SessionJournal.GRID:
+            (session.center, session.radius, session.showGrid) = ((int(last["x"]), int(last["y"])), int(last["id"]), bool(last["h"]))
+        elif op == SessionJournal.AZIMUTH:
+            session.anchor = (int(last["x"]), int(last["y"]))
+            session.field_azimuth = float(last["h"])
+            session.field_azimuth_coords = field_azimuth_end(session.center, session.radius, session.field_azimuth, session.anchor) or session.field_azimuth_coords
+        elif op == SessionJournal.CALCULATED:
+            (ids, xs, ys, horizons, azimuths) = session.dots.columns()
+            session.dots.set_computed(*calculate_dots(session.center, session.radius, session.field_azimuth_coords, xs, ys))
+        elif op == SessionJournal.LINE:
+            numbers = run["id"]
+            breaks = [0] + (numpy.flatnonzero(numpy.diff(numbers)) + 1).tolist() + [len(run)]
+            for (first, last) in zip(breaks[:-1], breaks[1:]):
+                session.lines.append(numpy.column_stack((run["x"][first:last], run["y"][first:last])))
+
+
+####################################################################
+# Class: Profiler
+# Opt-in instrumentation (-p on the command line). Methods are wrapped with
+# a timer when profiling starts, so nothing is measured (or slowed down)
+# otherwise. Each name gets a latency histogram in power of two milliseconds,
+# gauges keep the last and peak value of things like the dot count.
+####################################################################
+class Profiler:
+
+    BUCKETS = [1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024]    # upper edges in ms, plus one overflow bucket
+
+    def __init__(self, report_file):
+        self.report_file = report_file
+        self.started = time.time()
+        self.timings = OrderedDict()    # name -> [count, total seconds, max seconds, histogram]
+        self.gauges = OrderedDict()     # name -> [last, peak]
+        self.lock = threading.Lock()    # render runs on the loader and render threads too
+
+    def record(self, name, seconds):
+
+        ms = seconds * 1000
+        b = 0
+        while b < len(self.BUCKETS) and ms >= self.BUCKETS[b]:
+            b += 1
+
+        with self.lock:
+            t = self.timings.get(name)
+            if t is None:
+                t = self.timings[name] = [0, 0.0, 0.0, [0] * (len(self.BUCKETS) + 1)]
+
+            t[0] += 1
+            t[1] += seconds
+            t[2] = max(t[2], seconds)
+            t[3][b] += 1
+
+    def gauge(self, name, value):
+
+        with self.lock:
+            g = self.gauges.get(name)
+            if g is None:
+                self.gauges[name] = [value, value]
+            else:
+                g[0] = value
+                g[1] = max(g[1], value)
+
+    def wrap(self, name, fn):
+
+        def timed(*args, **kw):
+            start = time.time()
+            try:
+                return fn(*args, **kw)
+            finally:
+                self.record(name, time.time() - start)
+
+        timed.__name__ = fn.__name__
+        return timed
+
+    def instrument(self, cls, names):
+
+        # names maps method names of cls to the names they're reported under
+        for (method, name) in names.items():
+            setattr(cls, method, self.wrap(name, cls.__dict__[method]))
+
+    def count(self, name):
+
+        with self.lock:
+            t = self.timings.get(name)
+            return t[0] if t else 0
+
+    def percentile(self, name, p):
+        with self.lock:
+            return self.bucket_edge(self.timings[name], p)
+
+    def bucket_edge(self, timing, p):
+
+        # upper edge of the histogram bucket holding the p-th percentile, in ms
+        (count, total, longest, histogram) = timing
+        seen = 0
+        for (b, n) in enumerate(histogram):
+            seen += n
+            if seen >= count * p:
+                return self.BUCKETS[b] if b < len(self.BUCKETS) else round(longest * 1000, 1)
+        return 0
+
+    def report(self):
+
+        labels = ["<%d ms" % edge for edge in self.BUCKETS] + [">=%d ms" % self.BUCKETS[-1]]
+        with self.lock:
+            timings = OrderedDict()
+            for (name, timing) in self.timings.items():
+                (count, total, longest, histogram) = timing
+                timings[name] = OrderedDict([
+                    ("count", count),
+                    ("total_ms", round(total * 1000, 3)),
+                    ("mean_ms", round(total * 1000 / count, 3)),
+                    ("max_ms", round(longest * 1000, 3)),
+                    ("p50_ms", self.bucket_edge(timing, 0.5)),
+                    ("p95_ms", self.bucket_edge(timing, 0.95)),
+                    ("histogram", OrderedDict(zip(labels, histogram)))])
+
+            gauges = OrderedDict((name, OrderedDict([("last", last), ("peak", peak)]))
+                                 for (name, (last, peak)) in self.gauges.items())
+
+        return OrderedDict([("seconds", round(time.time() - self.started, 3)),
+                            ("timings", timings),
+                            ("gauges", gauges)])
+
+    def dump(self):
+
+        f = open(self.report_file, 'w')
+        try:
+            json.dump(self.report(), f, indent=2)
+        finally:
+            f.close()
+        logging.info('Profile written to %s', self.report_file)
+
+
 ####################################################################
 # Class: LoadImageApp
 # Main App, created in Main()
@@ -100,20 +1672,85 @@ class LoadImageApp:
     tool = "move"          # value can be "move", "dot", "line", "select", or "grid"
     xold, yold = None, None
     viewport = (0,0)       # Use for zoom and pan, this is adjusted whenever image is zoom/pan
-    zoomcycle = 0          # from -10 to 10, 0 is no zoom
-    MIN_ZOOM = -10
+    zoomcycle = 0          # from MIN_ZOOM to MAX_ZOOM, 0 is no zoom
+    MIN_ZOOM = -30         # low enough to fit images of several thousand pixels in the window
     MAX_ZOOM = 15
-    raw_image = None       # a reference to the raw image (of class Image)
-    zoomed_image = None    # reference to the zoomed image (of class Image)
+    raw_image = None       # a reference to the full resolution raw image (of class TiledImage, or HighBitImage)
+    pyramid = None         # power-of-two reductions of raw_image (of class ImagePyramid)
     showGrid = False
     field_azimuth = 0      # Define an angle of field azimuth from anchor (in degrees)
     field_azimuth_coords = (0,0)   # Store field Azimuth coordinates (end point)
     anchor = (0,0)         # Store the orange point coordinate
-
-
-    # A list of saved dots, dots is a 2D list where each column contains X,Y coordinates of dots
-    # as well as their Horizon Elevation and Azimuth if Field Azimuth is defined
-    dots = []
+    PAN_OVERSCAN = 256     # pixels rendered around the window on each side while panning
+    pan_buffer = 0         # overscan of the image currently on the canvas
+    pan_origin = (0,0)     # viewport the canvas items were rendered at
+    pan_offset = (0,0)     # how far the canvas items were moved since they were rendered
+    FRAME_BUDGET = 16      # minimum milliseconds between two redraws (about 60 frames/sec)
+    redraw_pending = None  # id of the scheduled redraw, if any
+    redraw_overscan = 0    # overscan asked for by the latest redraw request
+    redraw_interactive = False     # the latest redraw request is for a zoom or pan in progress
+    INTERACTIVE_FILTER = Image.BILINEAR    # filter of the frames while zooming and panning (-i)
+    REFINE_DELAY = 150     # milliseconds without input before the view is rendered with ANTIALIAS (-w)
+    refine_job = None      # id of the scheduled ANTIALIAS render
+    EXPOSURE_STEP = 0.5    # stops of a Tone > Brighter / Darker step, for 16 bit images
+    CONTRAST_STEP = 1.2    # factor of a Tone > More / Less Contrast step
+    FILTERS = {"nearest": Image.NEAREST, "bilinear": Image.BILINEAR, "bicubic": Image.BICUBIC,
+               "antialias": Image.ANTIALIAS}
+    last_frame = 0         # time the last redraw finished
+    renderer = None        # RenderWorker the regions are rendered on, started with the first redraw
+    render_poll = None     # id of the scheduled check for a rendered frame
+    RENDER_POLL = 5        # milliseconds between two checks for a rendered frame
+    IMPORT_CHUNK = 5000    # CSV rows imported (and dots drawn) per step of an import
+    DOT_RASTER_LIMIT = 2000        # above this many visible dots, they're drawn into one image
+    dot_layer = None       # PhotoImage of the rasterized dots, None while dots are canvas items
+    dots_drawn = 0         # dots in the view at the last drawDots()
+    grid_geometry = None   # ((center, radius), spoke end points in raw coords) of the last grid drawn
+    grid_at = None         # (scale, vx, vy) the grid items on the canvas are currently drawn at
+    dots_at = None         # (scale, vx, vy) the dot items are drawn at, see drawDots()
+    shown_at = None        # (scale, vx, vy) the image on the canvas is shown at, see to_raw()
+    lines_at = None        # (scale, vx, vy) the line items are drawn at
+    lines_drawn = 0        # lines that have an item on the canvas, they're only ever appended
+    LOADER_THREADS = 2     # images decoded in the background at the same time
+    PREFETCH = 3           # next images in the folder prepared ahead of time
+    PREFETCH_BUDGET = 512 << 20    # bytes of decoded images kept for prefetching
+    IMAGE_EXTENSIONS = ('.ppm', '.pgm', '.gif', '.jpg', '.jpeg', '.png', '.tif', '.tiff', '.bmp')
+    loading = None         # (image file, AsyncResult) of the image being opened
+    load_poll = None       # id of the scheduled check on the image being opened
+    importer = None        # chunks of the CSV import in progress (from iter_dots_csv)
+    import_job = None      # id of the scheduled import step
+    import_status = ""     # progress of the import, shown in the status bar
+    debug = False          # debug logging on, checked before logging on the hot paths
+    lookup = None          # HorizonLookup of the last grid used
+    lookup_building = None # key of the HorizonLookup being built on the lookup thread
+    lookup_failed = None   # key of the last HorizonLookup that couldn't be built, not tried again
+    session = None         # session file the dots and grid are saved to, see save_session()
+    journal = None         # SessionJournal of the session, the changes since it was saved
+    session_pending = None # (session file, read_session()) waiting for its image to be opened
+    stroke = None          # raw coords of the points of the line being drawn
+    LINE_STEP = 3          # window pixels the mouse moves before a line gets another point
+    LINE_TOLERANCE = 1.0   # window pixels a simplified line may be off the stroke drawn
+    LOOKUP_CACHE = None    # folder the lookups are saved in (-l), they're only kept in memory otherwise
+    LOOKUP_PIXELS = 1 << 25        # larger images only get a lookup with LOOKUP_CACHE (memory mapped)
+    LOOKUP_CACHE_BYTES = 2 << 30   # size of LOOKUP_CACHE, least recently used files go first
+    TILE_CACHE = None      # folder decoded images and pyramid levels are saved in (-c), see TileCache
+    TILE_CACHE_BYTES = 2 << 30     # size of TILE_CACHE (-m), least recently used files go first
+    tile_cache = None      # TileCache of TILE_CACHE
+    profiler = None        # Profiler when profiling (-p), its summary is shown in the status bar
+    profile_status = ""
+    cursor_status = ""
+    PROFILE_INTERVAL = 1000        # milliseconds between two profile samples
+    # methods timed when profiling, and the names they're reported under ("frame" is a frame shown)
+    PROFILED = {"show_region": "frame", "redraw": "redraw", "display_region": "display_region",
+                "drawDots": "drawDots", "drawGrid": "drawGrid", "drawAzimuth": "drawAzimuth",
+                "azimuth_calculation": "azimuth_calculation", "import_step": "import_step",
+                "save_csv": "save_csv", "init_canvas": "init_canvas", "zoomer": "zoomer",
+                "zoomin": "zoomin", "zoomout": "zoomout", "b1down": "b1down", "b1up": "b1up",
+                "motion": "motion", "resize_window": "resize_window"}
+
+
+    # The saved dots (of class DotStore), with the X,Y coordinates of dots as well as
+    # their Horizon Elevation and Azimuth if Field Azimuth is defined
+    dots = None
 
     ####################################################################
     # Function: __init__
@@ -126,24 +1763,22 @@ class LoadImageApp:
         self.parent = root
         self.frame = Frame(root,bg='white')
         self.imageFile = image_file
+        self.dots = DotStore()
+        self.dot_items = {}     # dot ID -> canvas item of the dots drawn as items
+        self.lines = []         # the lines drawn, each an (n, 2) array of raw image coords
+        self.loader = ImageLoader(self.prepare_image, self.LOADER_THREADS, self.PREFETCH_BUDGET)
+        atexit.register(self.loader.close)
+        if self.TILE_CACHE:
+            self.tile_cache = TileCache(self.TILE_CACHE, self.TILE_CACHE_BYTES)
 
         logging.debug('Image File Name: %s', image_file)
 
         # Initialize the scaling/zoom table
-        self.mux = {0 : 1.0}
-        for n in range(1,self.MAX_ZOOM+1,1):
-            self.mux[n] = round(self.mux[n-1] * 1.1, 5)
-
-        for n in range(-1, self.MIN_ZOOM-1, -1):
-            self.mux[n] = round(self.mux[n+1] * 0.9, 5)
+        self.mux = zoom_factors(self.MIN_ZOOM, self.MAX_ZOOM)
 
         # Create a blank canvas of size 800*600
         self.canvas = Canvas(self.frame,width=800,height=600,bg='white')
 
-        # If image file is provided, this will create the image in the canvas
-        if image_file:
-            self.init_canvas(self.canvas,image_file)
-
         self.frame.pack(fill='both', expand=1)
         self.canvas.pack(fill='both', expand=1)
 
@@ -155,7 +1790,10 @@ class LoadImageApp:
                                 ('pgm files', '.pgm'),
                                 ('gif files', '.gif'),
                                 ('jpg files', '.jpg'),
-                                ('jpeg files', '.jpeg')]
+                                ('jpeg files', '.jpeg'),
+                                ('png files', '.png'),
+                                ('tiff files', ('.tif', '.tiff')),
+                                ('bmp files', '.bmp')]
         options['initialdir'] = '.'
 
         # The following data structure is for importing csv file (open file dialog)
@@ -165,12 +1803,24 @@ class LoadImageApp:
                                 ('csv files', '.csv')]
         csv_options['initialdir'] = '.'
 
+        # The following data structure is for session files (open and save dialogs)
+        self.session_opt = session_options = {}
+        session_options['defaultextension'] = '.session'
+        session_options['filetypes'] = [('all files', '.*'),
+                                ('session files', '.session')]
+        session_options['initialdir'] = '.'
+
         # Menu items
         menubar = Menu(root)
         filemenu = Menu(menubar,tearoff=0)
         filemenu.add_command(label="Open Image", command=self.open_file)
+        filemenu.add_command(label="Next Image in Folder", command=self.next_image)
+        filemenu.add_command(label="Previous Image in Folder", command=self.previous_image)
         filemenu.add_command(label="Import from CSV", command=self.open_csv)
+        filemenu.add_command(label="Cancel Import", command=self.cancel_import)
         filemenu.add_command(label="Export to CSV", command=self.save_csv)
+        filemenu.add_command(label="Open Session", command=self.open_session)
+        filemenu.add_command(label="Save Session", command=self.save_session)
         filemenu.add_command(label="Exit", command=self.exit_app)
         menubar.add_cascade(label="File", menu=filemenu)
 
@@ -193,6 +1843,14 @@ class LoadImageApp:
         zoommenu.add_command(label="Zoom Out", command=self.zoomout)
         menubar.add_cascade(label="Zoom",menu=zoommenu)
 
+        tonemenu = Menu(menubar, tearoff=0)
+        tonemenu.add_command(label="Brighter", command=lambda: self.adjust_tone(exposure=self.EXPOSURE_STEP))
+        tonemenu.add_command(label="Darker", command=lambda: self.adjust_tone(exposure=-self.EXPOSURE_STEP))
+        tonemenu.add_command(label="More Contrast", command=lambda: self.adjust_tone(contrast=self.CONTRAST_STEP))
+        tonemenu.add_command(label="Less Contrast", command=lambda: self.adjust_tone(contrast=1 / self.CONTRAST_STEP))
+        tonemenu.add_command(label="Reset", command=self.reset_tone)
+        menubar.add_cascade(label="Tone",menu=tonemenu)
+
         # Attach created menu to root window
         root.config(menu=menubar)
 
@@ -201,22 +1859,39 @@ class LoadImageApp:
         self.status.pack(side=BOTTOM, fill=X)
 
         # Event binding
+        root.bind("<Escape>", self.cancel_import)
+        root.bind("<Next>", self.next_image)
+        root.bind("<Prior>", self.previous_image)
         self.canvas.bind("<MouseWheel>",self.zoomer)
         self.canvas.bind("<Motion>", self.motion)
         self.canvas.bind("<ButtonPress-1>", self.b1down)
         self.canvas.bind("<ButtonRelease-1>", self.b1up)
         self.canvas.bind("<Configure>", self.resize_window)
 
+        # If image file is provided, it's opened once the window is up (a preview first for JPEGs)
+        if image_file:
+            self.open_image(image_file)
+
+        if self.profiler:
+            self.profile_frames = 0
+            self.profile_sample()
+
     ####################################################################
     # Function: init_canvas(), initialize the canvas with the image provided
     # Args:  canvas
     #        image_file     name of image file
+    #        prepared       result of prepare_image() for image_file, if it's ready
     # Returns:  None
     ####################################################################
-    def init_canvas(self, canvas, image_file):
+    def init_canvas(self, canvas, image_file, prepared=None):
 
         logging.debug('init_canvas() called')
 
+        # A new image also drops the dots of an import in progress, and the frames still being rendered
+        self.cancel_import()
+        if self.renderer:
+            self.renderer.cancel()
+
         # Reset these variables when a new image is opened
         self.button_1 = "up"
         self.tool = "move"
@@ -228,148 +1903,364 @@ class LoadImageApp:
         self.field_azimuth_coords = (0,0)   # Store field Azimuth coordinates (end point)
         self.anchor = (0,0)         # Store the orange point coordinate
 
+        # The session of the previous image (if any) is done with, see apply_session()
+        self.close_session()
 
-        del self.dots[:]
+        self.dots.clear()
+        self.lines = []
+        self.stroke = None
+        self.dot_items = {}
+        self.dot_layer = None
+        self.dots_at = self.lines_at = self.grid_at = self.shown_at = None
+        self.lines_drawn = 0
 
         if image_file:
 
+            if prepared is None:
+                prepared = self.prepare_image(image_file)
+
             self.imageFile = image_file
-            self.raw_image = Image.open(image_file)
+            (self.raw_image, self.pyramid, self.zoomcycle, first_view) = prepared
             (width, height) = self.raw_image.size
 
-            # If image is larger than 1000 pixels, resize it to less than 800 x 600
-            if width > 1000 or height > 1000:
-                self.raw_image.thumbnail((800,600),Image.ANTIALIAS)
-                (width, height) = self.raw_image.size
-                print "Downsizing image to ", width, "x", height
+            if self.zoomcycle:
+                logging.info('Showing %d x %d image at %d%%', width, height, self.mux[self.zoomcycle] * 100)
+
+            # need to save a reference to the PhotoImage object, otherwise, image won't be shown
+            self.p_img = ImageTk.PhotoImage(first_view)
+
+            # Change the size of the canvas to new width and height based on image size
+            canvas.config(width=first_view.size[0], height=first_view.size[1])
+
+            # Remove all the previous canvas items
+            canvas.delete("all")
+            canvas.create_image(0,0,image=self.p_img, anchor="nw", tags="image")
+            self.shown_at = (self.mux[self.zoomcycle], 0, 0)
+
+            # Find the default center of image and radius
+            (self.center, self.radius) = default_grid((width, height))
+            self.field_azimuth = -1
+
+    ####################################################################
+    # Function: prepare_image(), everything about opening an image that doesn't need Tk,
+    #           this runs on an ImageLoader thread
+    # Args:  image_file     name of image file
+    # Returns:  (raw_image, pyramid, zoomcycle, first view at that zoom)
+    ####################################################################
+    def prepare_image(self, image_file):
+
+        raw_image = open_raw_image(image_file, self.tile_cache)
+        pyramid = ImagePyramid(raw_image, self.tile_cache)
+        zoomcycle = self.fit_zoom(raw_image.size)
+
+        scale = self.mux[zoomcycle]
+        first_view = pyramid.render((0,0), (int(raw_image.size[0] * scale), int(raw_image.size[1] * scale)), scale)
+
+        return (raw_image, pyramid, zoomcycle, first_view)
+
+    def fit_zoom(self, size):
+        return fit_zoom(size, self.mux, self.MIN_ZOOM)
+
+    def to_raw(self,(x,y), shown=False):
+
+        # This function will translate the x,y coordinate from window to raw_image coordinate.
+        # Mouse input is translated as shown: by the zoom and pan of the image on the canvas,
+        # which lag behind zoomcycle and viewport until the frame rendered for them is shown
+        (rx, ry) = to_raw_array(x, y, *self.transform(shown))
+        return (int(rx), int(ry))
+
+    def to_window(self, (x,y), shown=False):
+        # This function will translate the x,y coordinate from raw_image coordinate to window coordinate
+        (wx, wy) = to_window_array(x, y, *self.transform(shown))
+        return (int(wx), int(wy))
 
-            self.zoomed_image = self.raw_image
+    def transform(self, shown=False):
 
-            # need to save a reference to the PhotoImage object, otherwise, image won't be shown
-            self.p_img = ImageTk.PhotoImage(self.raw_image)
+        # (viewport, scale) of the zoom and pan asked for, or (shown) of the image on the canvas
+        if shown and self.shown_at:
+            return (self.shown_at[1:], self.shown_at[0])
+        return (self.viewport, self.mux[self.zoomcycle])
 
-            # Change the size of the canvas to new width and height based on image size
-            canvas.config(width=width, height=height)
+    def drawDots(self, my_canvas):
 
-            # Remove all the previous canvas items
-            canvas.delete("all")
-            canvas.create_image(0,0,image=self.p_img, anchor="nw")
+        # Only the dots in the visible part of the raw image (and the pan overscan) are drawn
+        (vx, vy) = self.viewport
+        scale = self.mux[self.zoomcycle]
+        o = self.pan_buffer + 2
+        w,h = self.frame.winfo_width(), self.frame.winfo_height()
 
-            # Find the default center of image and radius
-            self.center = (int(width/2), int(height/2))
-            self.radius = int(math.sqrt(self.center[0] * self.center[0] + self.center[1] * self.center[1]))
-            self.field_azimuth = -1
+        ids = self.dots.query((vx - o) / scale, (vy - o) / scale, (vx + w + o) / scale, (vy + h + o) / scale)
+        (xs, ys) = self.dots.coords(ids)
+        self.dots_drawn = len(ids)
+        if self.debug:
+            logging.debug('drawDots() -> %d of %d dots visible', len(ids), len(self.dots))
+
+        # Too many dots for canvas items, composite them into a single image instead
+        if len(ids) > self.DOT_RASTER_LIMIT:
+            self.clearDots(my_canvas)
+            self.dot_layer = self.rasterDots(xs, ys, (0, 0, 255, 255))
+            my_canvas.create_image(-self.pan_buffer, -self.pan_buffer, image=self.dot_layer, anchor="nw", tags=("dot", "dot_layer"))
+        else:
+            my_canvas.delete("dot_layer")
+            self.dot_layer = None
+            self.drawDotItems(my_canvas, ids, xs, ys)
 
-    def to_raw(self,(x,y)):
+    def clearDots(self, my_canvas):
 
-        # This function will translate the x,y coordinate from window to raw_image coordinate
-        (vx, vy) = self.viewport
-        return (int((x + vx)/ self.mux[self.zoomcycle]),int((y + vy)/ self.mux[self.zoomcycle]))
+        # Take all the dots (items or rasterized) off the canvas
+        my_canvas.delete("dot")
+        self.dot_items = {}
+        self.dot_layer = None
+        self.dots_at = None
 
-    def to_window(self, (x,y)):
-        # This function will translate the x,y coordinate from raw_image coordinate to window coordinate
+    ####################################################################
+    # Function: drawDotItems(), bring the dot items on the canvas in line with the dots
+    # Args:  my_canvas
+    #        ids, xs, ys    the dots in view (from the dot store's index)
+    # Returns:  None
+    # The items stay on the canvas across redraws, keyed by dot ID in dot_items.
+    # The ones already there are moved to the current zoom and pan, only the dots
+    # that came into view get a new item and the ones that left lose theirs.
+    ####################################################################
+    def drawDotItems(self, my_canvas, ids, xs, ys):
+
+        scale = self.mux[self.zoomcycle]
         (vx, vy) = self.viewport
-        return (int(x * self.mux[self.zoomcycle]) - vx,int(y * self.mux[self.zoomcycle]) - vy)
+        (wxs, wys) = to_window_array(xs, ys, self.viewport, scale)
 
-    def drawDots(self, my_canvas):
+        # Skip the dots outside of the window (and the pan overscan)
+        o = self.pan_buffer + 2
+        w,h = self.frame.winfo_width(), self.frame.winfo_height()
+        inside = (wxs >= -o) & (wxs <= w + o) & (wys >= -o) & (wys <= h + o)
+        visible = dict(zip(numpy.asarray(ids)[inside].tolist(), zip(wxs[inside].tolist(), wys[inside].tolist())))
+
+        # The dots that left the view
+        for dot_id in [dot_id for dot_id in self.dot_items if dot_id not in visible]:
+            my_canvas.delete(self.dot_items.pop(dot_id))
+
+        # A pan moves all the items at once, a zoom puts each of them at its new coords
+        if self.dot_items and self.dots_at != (scale, vx, vy):
+            (old_scale, ovx, ovy) = self.dots_at
+            if old_scale == scale:
+                my_canvas.move("dot", ovx - vx, ovy - vy)
+            else:
+                for (dot_id, item) in self.dot_items.items():
+                    (x, y) = visible[dot_id]
+                    my_canvas.coords(item, x-2, y-2, x+2, y+2)
 
-        logging.debug('drawDots() -> %s', self.print_dots())
+        # Each dot item is tagged with its dot ID, so it can be found again from the dots
+        for (dot_id, (x, y)) in visible.items():
+            if dot_id not in self.dot_items:
+                self.dot_items[dot_id] = my_canvas.create_oval(x-2,y-2,x+2,y+2,fill="blue",tags=("dot", "dot%d" % dot_id))
 
-        rows = len(self.dots)
-        for row in xrange(rows):
+        self.dots_at = (scale, vx, vy)
 
-            dot = self.dots[row]
+    def drawLines(self, my_canvas):
 
-            (x,y) = self.to_window((dot[0],dot[1]))
-            item = my_canvas.create_oval(x-2,y-2,x+2,y+2,fill="blue")
-            my_canvas.itemconfig(item, tags=("dot", str(dot[0]), str(dot[1])))
+        # One polyline item per line. Like the grid, the lines on the canvas are only transformed
+        # on zoom and pan, the lines added since the last time get their items.
+        scale = self.mux[self.zoomcycle]
+        (vx, vy) = self.viewport
 
+        if self.lines_at and self.lines_drawn and self.lines_at != (scale, vx, vy):
+            (old_scale, ovx, ovy) = self.lines_at
+            f = scale / old_scale
+            my_canvas.scale("line", 0, 0, f, f)
+            my_canvas.move("line", ovx * f - vx, ovy * f - vy)
+
+        for n in xrange(self.lines_drawn, len(self.lines)):
+            # Window coords are kept fractional, so that later transforms don't magnify rounding
+            coords = (self.lines[n] * scale - (vx, vy)).ravel().tolist()
+            my_canvas.create_line(*coords, smooth=TRUE, fill="blue", width=5, tags=("line", "line%d" % n))
+
+        self.lines_drawn = len(self.lines)
+        self.lines_at = (scale, vx, vy)
+
+    def rasterDots(self, xs, ys, fill):
+
+        # Draw the dots as 5x5 squares (black border, fill color inside) into one transparent
+        # PhotoImage covering the window and the pan overscan, placed at (-overscan,-overscan)
+        o = self.pan_buffer
+        w,h = self.frame.winfo_width() + 2*o, self.frame.winfo_height() + 2*o
+
+        # Mark the dot centers, with 2 extra pixels around for dots just outside of the image
+        (wxs, wys) = to_window_array(xs, ys, self.viewport, self.mux[self.zoomcycle])
+        wxs, wys = wxs + o + 2, wys + o + 2
+        inside = (wxs >= 0) & (wxs < w + 4) & (wys >= 0) & (wys < h + 4)
+        centers = numpy.zeros((h + 4, w + 4), dtype=bool)
+        centers[wys[inside], wxs[inside]] = True
+
+        # Grow the centers into 3x3 (fill) and 5x5 (fill + border) squares, rows then columns
+        squares = []
+        for r in (1, 2):
+            grown = centers.copy()
+            for d in range(1, r + 1):
+                grown[d:] |= centers[:-d]
+                grown[:-d] |= centers[d:]
+            rows = grown.copy()
+            for d in range(1, r + 1):
+                grown[:, d:] |= rows[:, :-d]
+                grown[:, :-d] |= rows[:, d:]
+            squares.append(grown[2:-2, 2:-2])
+
+        layer = numpy.zeros((h, w, 4), dtype=numpy.uint8)
+        layer[squares[1]] = (0, 0, 0, 255)
+        layer[squares[0]] = fill
+
+        return ImageTk.PhotoImage(Image.fromarray(layer, "RGBA"))
+
+    # Grid, azimuth and anchor items are "overlay" items: they stay on the canvas across redraws
     def drawGrid(self, my_canvas, center, radius):
 
-        logging.debug('drawGrid() -> center = %d, %d, radius = %d', center[0], center[1], radius)
+        scale = self.mux[self.zoomcycle]
+        (vx, vy) = self.viewport
+
+        # If this grid is already on the canvas, zoom and pan only transform its items:
+        # from raw*old_scale - old_viewport to raw*scale - viewport
+        if self.grid_at and self.grid_geometry[0] == (center, radius) and my_canvas.find_withtag("grid"):
+            (old_scale, ovx, ovy) = self.grid_at
+            f = scale / old_scale
+            my_canvas.scale("grid", 0, 0, f, f)
+            my_canvas.move("grid", ovx * f - vx, ovy * f - vy)
+            self.grid_at = (scale, vx, vy)
+            return
+
+        if self.debug:
+            logging.debug('drawGrid() -> center = %d, %d, radius = %d', center[0], center[1], radius)
 
         # remove old grid before drawing new ones
         my_canvas.delete("grid")
 
-        (wX,wY) = self.to_window(center)
-        wR = radius * self.mux[self.zoomcycle]
+        # The spokes every 5 degrees (in clock-wise direction) only depend on center and radius
+        if self.grid_geometry is None or self.grid_geometry[0] != (center, radius):
+            spokes = [(center[0] + int(radius * math.cos(math.radians(n))), center[1] + int(radius * math.sin(math.radians(n))))
+                      for n in range(5,365,5)]
+            self.grid_geometry = ((center, radius), spokes)
+
+        # Window coords are kept fractional here, so that later transforms don't magnify rounding
+        (wX,wY) = (center[0] * scale - vx, center[1] * scale - vy)
+        wR = radius * scale
 
         x = wX - wR
         y = wY - wR
 
-        my_canvas.create_oval(x,y,x+(2*wR),y+(2*wR),tag="grid")
+        my_canvas.create_oval(x,y,x+(2*wR),y+(2*wR),tags=("grid", "overlay"))
 
-        # Draw spokes every 5 degrees (in clock-wise direction)
-        for n in range(5,365,5):
-            rX = center[0] + int(radius * math.cos(math.radians(n)))
-            rY = center[1] + int(radius * math.sin(math.radians(n)))
-            pX,pY = self.to_window((rX,rY))
-            my_canvas.create_line(wX,wY,pX,pY,tag="grid")
+        for (rX, rY) in self.grid_geometry[1]:
+            pX,pY = rX * scale - vx, rY * scale - vy
+            my_canvas.create_line(wX,wY,pX,pY,tags=("grid", "overlay"))
+
+        self.grid_at = (scale, vx, vy)
 
     # Draw the azimuth line in dotted green from center to radius in reference to anchor point based on angle (azimuth) given
     # anchor is in degrees from 0 (east) clockwise direction, ie. 90 degree is south, 180 is west, 270 north
     # The arguments are all in raw image ratio
     def drawAzimuth(self, my_canvas, center, radius, azimuth, anchor):
 
-        logging.debug('drawAzimuth() -> center = %d, %d, radius = %d, azimuth = %d, anchor = %d, %d', center[0], center[1], radius, azimuth, anchor[0], anchor[1])
-
-        # Find the angle for the anchor point from a standard ciricle (1,0) 0 degrees
-        anchor_angle = self.find_angle(center,(center[0]+radius, center[1]),anchor)
-        adjusted_azimuth = anchor_angle + azimuth
-        #logging.debug('adjusted azimuth = %d, %d, %d', adjusted_azimuth, anchor_angle, azimuth)
-
-        if adjusted_azimuth > 360:
-            adjusted_azimuth = adjusted_azimuth - 360
+        if self.debug:
+            logging.debug('drawAzimuth() -> center = %d, %d, radius = %d, azimuth = %d, anchor = %d, %d', center[0], center[1], radius, azimuth, anchor[0], anchor[1])
 
         # Field Azimuth angle is in reference to the anchor point (in orange)
-        if adjusted_azimuth >= 0 and adjusted_azimuth <= 360:
-            my_canvas.delete("azimuth")
-
-            old_anchor = my_canvas.find_withtag("anchor")
-            if old_anchor:
-                my_canvas.delete(old_anchor)
+        end = field_azimuth_end(center, radius, azimuth, anchor)
+        if end:
+            # Store the field azimuth coordinates (end point) so that it can be used later to calculate dot azimuth
+            self.field_azimuth_coords = end
 
             ax, ay = self.to_window(anchor)
-
-            my_canvas.create_oval(ax-2,ay-2,ax+2,ay+2,tag = "anchor", fill="orange")
-
             (wX,wY) = self.to_window(center)
+            pX,pY = self.to_window(end)
+
+            # The anchor and the field azimuth line are moved in place once they're on the canvas
+            if my_canvas.find_withtag("anchor"):
+                my_canvas.coords("anchor", ax-2, ay-2, ax+2, ay+2)
+            else:
+                my_canvas.create_oval(ax-2,ay-2,ax+2,ay+2,tags=("anchor", "overlay"), fill="orange")
 
             # Draw the field azimuth in reference to the anchor point
-            rX = center[0] + int(radius * math.cos(math.radians(adjusted_azimuth)))
-            rY = center[1] + int(radius * math.sin(math.radians(adjusted_azimuth)))
+            if my_canvas.find_withtag("azimuth"):
+                my_canvas.coords("azimuth", wX, wY, pX, pY)
+            else:
+                my_canvas.create_line(wX,wY,pX,pY, tags=("azimuth", "overlay"), fill="green", dash=(4, 4), width=3)
 
-            # Store the field azimuth coordinates (end point) so that it can be used later to calculate dot azimuth
-            self.field_azimuth_coords = (rX, rY)
 
-            pX,pY = self.to_window((rX,rY))
-            my_canvas.create_line(wX,wY,pX,pY, tag="azimuth", fill="green", dash=(4, 4), width=3)
+    def display_region(self, my_canvas, overscan=0, resample=Image.ANTIALIAS):
 
+        # only display the region of the zoomed image starting at viewport and window size,
+        # the zoomed image itself is never built, only the visible part is resampled.
+        # With overscan, an extra border is rendered around the window for panning.
+        # The region is rendered (and the pyramid level it needs built) on the render
+        # thread, check_render() puts it on the canvas when it's done. resample is the
+        # filter of the final resize (cheaper ones while zooming and panning).
+        (x,y) = self.viewport
+        w,h = self.frame.winfo_width(), self.frame.winfo_height()
 
-    def scale_image(self):
+        if self.renderer is None:
+            self.renderer = RenderWorker()
+            atexit.register(self.renderer.close)
 
-        # resize the image based on the scaling factor (mux), update the self.zoomed_image
-        raw_x, raw_y = self.raw_image.size
-        new_w, new_h = int(raw_x * self.mux[self.zoomcycle]), int(raw_y * self.mux[self.zoomcycle])
-        self.zoomed_image = self.raw_image.resize((new_w,new_h), Image.ANTIALIAS)
+        self.renderer.submit(self.pyramid, (x-overscan,y-overscan), (w+2*overscan,h+2*overscan), self.mux[self.zoomcycle], resample)
+        if not self.render_poll:
+            self.render_poll = my_canvas.after(self.RENDER_POLL, self.check_render)
 
-    def display_region(self, my_canvas):
+    def check_render(self):
 
-        my_canvas.delete("all")
+        # Show the latest frame rendered, unless it's of another image or zoom (a newer request is
+        # under way then). A frame made for an older viewport is shown where the viewport puts it.
+        frame = self.renderer.collect()
+        if frame:
+            (generation, pyramid, origin, size, scale, resample, region) = frame
+            if pyramid is self.pyramid and scale == self.mux[self.zoomcycle]:
+                self.show_region(self.canvas, region, origin)
+            elif self.debug:
+                logging.debug('check_render() -> frame %d dropped', generation)
 
-        # only display the region of the zoomed_image starting at viewport and window size
-        (x,y) = self.viewport
-        w,h = self.frame.winfo_width(), self.frame.winfo_height()
+        if self.renderer.pending():
+            self.render_poll = self.canvas.after(self.RENDER_POLL, self.check_render)
+        else:
+            self.render_poll = None
 
-        tmp = self.zoomed_image.crop((x,y,x+w,y+h))
+    ####################################################################
+    # Function: show_region(), put a rendered region on the canvas
+    # Args:  my_canvas
+    #        region         Image rendered by the render thread
+    #        origin         top left corner of region in zoomed image coords
+    # Returns:  None
+    # The items on the canvas stay: the image item gets the new region, the dots, lines,
+    # grid, azimuth and anchor are moved to the current zoom and pan (see drawDotItems())
+    ####################################################################
+    def show_region(self, my_canvas, region, origin):
 
-        self.p_img = ImageTk.PhotoImage(tmp)
+        (x,y) = self.viewport
+        w,h = self.frame.winfo_width(), self.frame.winfo_height()
+        (ox, oy) = origin
+        (rw, rh) = region.size
+
+        # the overscan the region leaves around the window, panning within it needs no redraw
+        self.pan_buffer = max(0, min(x - ox, y - oy, ox + rw - x - w, oy + rh - y - h))
+        self.pan_origin = self.viewport
+        self.pan_offset = (0,0)
+        self.shown_at = (self.mux[self.zoomcycle], x, y)
+
+        start = time.time()
+        self.p_img = ImageTk.PhotoImage(region)
+        if self.profiler:
+            self.profiler.record("PhotoImage", time.time() - start)
         my_canvas.config(bg="white")
-        my_canvas.create_image(0,0,image=self.p_img, anchor="nw")
+        if my_canvas.find_withtag("image"):
+            my_canvas.itemconfig("image", image=self.p_img)
+            my_canvas.coords("image", ox - x, oy - y)
+        else:
+            my_canvas.create_image(ox - x, oy - y, image=self.p_img, anchor="nw", tags="image")
+            my_canvas.tag_lower("image")
 
         # draw the saved dots
         if self.dots:
             self.drawDots(my_canvas)
+        elif self.dot_items or self.dot_layer:
+            self.clearDots(my_canvas)
+
+        if self.lines:
+            self.drawLines(my_canvas)
 
         if self.showGrid:
             self.drawGrid(my_canvas, self.center, self.radius)
@@ -377,6 +2268,56 @@ class LoadImageApp:
             if self.field_azimuth >=0 and self.field_azimuth <= 360:
                 self.drawAzimuth(my_canvas, self.center, self.radius, self.field_azimuth, self.anchor)
 
+        # keep the overlays above the new image and dots
+        my_canvas.tag_raise("overlay")
+
+    ####################################################################
+    # Function: request_redraw(), mark the canvas dirty and schedule one redraw
+    # Args:  overscan       passed on to display_region()
+    #        interactive    the redraw is for a zoom or pan in progress, see redraw()
+    # Returns:  None
+    # Requests made before the scheduled redraw runs are coalesced into it, the
+    # redraw always uses the latest viewport and zoom, and never runs sooner than
+    # FRAME_BUDGET milliseconds after the previous one.
+    ####################################################################
+    def request_redraw(self, overscan=0, interactive=False):
+
+        self.redraw_overscan = overscan
+        self.redraw_interactive = interactive
+
+        if self.redraw_pending:
+            return
+
+        elapsed = int((time.time() - self.last_frame) * 1000)
+        if elapsed >= self.FRAME_BUDGET:
+            self.redraw_pending = self.canvas.after_idle(self.redraw)
+        else:
+            self.redraw_pending = self.canvas.after(self.FRAME_BUDGET - elapsed, self.redraw)
+
+    def redraw(self):
+
+        self.redraw_pending = None
+
+        # While zooming and panning, frames are resampled with INTERACTIVE_FILTER. Once there's
+        # been no input for REFINE_DELAY, the same view is rendered again with ANTIALIAS.
+        if self.refine_job:
+            self.canvas.after_cancel(self.refine_job)
+            self.refine_job = None
+
+        if self.raw_image:
+            if self.redraw_interactive and self.INTERACTIVE_FILTER != Image.ANTIALIAS:
+                self.display_region(self.canvas, self.redraw_overscan, self.INTERACTIVE_FILTER)
+                self.refine_job = self.canvas.after(self.REFINE_DELAY, self.refine, self.redraw_overscan)
+            else:
+                self.display_region(self.canvas, self.redraw_overscan)
+
+        self.last_frame = time.time()
+
+    def refine(self, overscan):
+
+        self.refine_job = None
+        self.request_redraw(overscan)
+
     ########################################################
     # The following are menu handlers
     ########################################################
@@ -387,11 +2328,129 @@ class LoadImageApp:
         if file:
             # Initialize the canvas with image file
             logging.debug('Opening image file: %s', file)
-            self.init_canvas(self.canvas,file)
+            self.open_image(file)
 
         else:
             logging.info('No file selected')
 
+    def open_image(self, image_file, session=None):
+
+        # The image is decoded on a loader thread, the canvas is set up once it's ready,
+        # and the session (read by open_session()) applied after that
+        image_file = os.path.abspath(image_file)
+        self.session_pending = session
+        self.loading = (image_file, self.loader.request(image_file))
+        self.status.config(text="Loading %s ..." % os.path.basename(image_file))
+
+        if not self.loading[1].ready():
+            self.show_preview(image_file)
+
+        if not self.load_poll:
+            self.check_loading()
+
+    def check_loading(self):
+
+        (image_file, job) = self.loading
+        if not job.ready():
+            self.load_poll = self.canvas.after(20, self.check_loading)
+            return
+
+        self.load_poll = None
+        self.loading = None
+
+        try:
+            prepared = job.get()
+        except Exception, e:
+            self.loader.forget(image_file)
+            self.session_pending = None
+            logging.error('Cannot open %s: %s', image_file, e)
+            self.status.config(text="Cannot open %s" % os.path.basename(image_file))
+            tkMessageBox.showerror("Open Image", "Cannot open %s:\n%s" % (image_file, e))
+            return
+
+        self.init_canvas(self.canvas, image_file, prepared)
+        self.status.config(text=os.path.basename(image_file))
+
+        if self.session_pending:
+            (session_file, session) = self.session_pending
+            self.session_pending = None
+            self.apply_session(session_file, session)
+
+        self.prefetch(image_file)
+
+    def show_preview(self, image_file):
+
+        # JPEGs can be decoded at 1/2 to 1/8 of their size (draft mode) in a fraction of the time
+        # of the full decode. That's shown, without the tools, until init_canvas() replaces it.
+        try:
+            image = Image.open(image_file)
+            if image.format != "JPEG":
+                return
+
+            scale = self.mux[self.fit_zoom(image.size)]
+            size = (int(image.size[0] * scale), int(image.size[1] * scale))
+            image.draft("RGB", size)
+            preview = image.convert("RGB").resize(size, Image.BILINEAR)
+        except IOError, e:
+            # the loader reports the image can't be opened
+            logging.debug('No preview of %s: %s', image_file, e)
+            return
+
+        logging.debug('Showing %d x %d preview of %s', size[0], size[1], image_file)
+
+        # The previous image is closed, there's no raw image (so no tools) until the full image is ready
+        self.init_canvas(self.canvas, None)
+        self.raw_image = None
+        self.pyramid = None
+
+        self.p_img = ImageTk.PhotoImage(preview)
+        self.canvas.config(width=size[0], height=size[1])
+        self.canvas.delete("all")
+        self.canvas.create_image(0, 0, image=self.p_img, anchor="nw", tags="image")
+
+    def folder_images(self, image_file):
+
+        # The image files in the folder of image_file, sorted by name
+        folder = os.path.dirname(os.path.abspath(image_file))
+        return sorted(os.path.join(folder, f) for f in os.listdir(folder)
+                      if os.path.splitext(f)[1].lower() in self.IMAGE_EXTENSIONS)
+
+    def prefetch(self, image_file):
+
+        # Start preparing the images around image_file, then ask for image_file
+        # again so it's the last one the loader would drop
+        image_file = os.path.abspath(image_file)
+        files = self.folder_images(image_file)
+        if image_file not in files:
+            return
+
+        n = files.index(image_file)
+        for f in files[max(0, n-1):n] + files[n+1:n+1+self.PREFETCH]:
+            self.loader.request(f)
+        self.loader.request(image_file)
+
+    def step_image(self, step):
+
+        # Open the image step files away from the current one in its folder
+        current = self.loading[0] if self.loading else self.imageFile
+        if not current:
+            return
+
+        current = os.path.abspath(current)
+        files = self.folder_images(current)
+        n = files.index(current) + step if current in files else -1
+
+        if 0 <= n < len(files):
+            self.open_image(files[n])
+        else:
+            self.status.config(text="No more images in this folder")
+
+    def next_image(self, event=None):
+        self.step_image(1)
+
+    def previous_image(self, event=None):
+        self.step_image(-1)
+
     def open_csv(self):
 
         # Open a CSV file that has dots X,Y coordinates
@@ -399,49 +2458,195 @@ class LoadImageApp:
 
         if file:
 
+            # Only one import at a time
+            self.cancel_import()
+
             # Delete the existing dots from canvas as well as dots data structure
-            self.canvas.delete("dot")
-            del self.dots[:]
+            self.clearDots(self.canvas)
+            self.dots.clear()
+
+            # The file is read and the dots drawn a chunk at a time from after() callbacks,
+            # so the window stays responsive during a large import
+            logging.info('Importing dots from %s', file)
+            self.import_file = file
+            self.importer = iter_dots_csv(file, self.IMPORT_CHUNK)
+            self.import_job = self.canvas.after_idle(self.import_step)
+        else:
+            logging.info('No file selected')
 
-            # Initialize the canvas with image file
-            f = open(file,'rt')
-            try:
-                reader = csv.reader(f)
-                rownum = 0
+    def import_step(self):
 
-                for row in reader:
+        try:
+            (xs, ys, done) = self.importer.next()
 
-                    # Save the header
-                    if rownum == 0:
-                        header = row
-                        logging.debug('Header Info: %s', header)
-                    else:
-                        self.dots.append((int(row[0]),int(row[1])))
-                    rownum += 1
-            finally:
-                f.close()
+        except StopIteration:
+            logging.info('Imported %d dots from %s', len(self.dots), self.import_file)
+            self.importer = None
+            self.import_status = ""
+            self.status.config(text="Imported %d dots" % len(self.dots))
+            return
 
-            self.drawDots(self.canvas)
-        else:
-            logging.info('No file selected')
+        except (ValueError, IndexError, csv.Error), e:
+            logging.error('Import of %s failed: %s', self.import_file, e)
+            self.cancel_import()
+            tkMessageBox.showerror("Import failed", "%s is not a valid dots file:\n%s" % (self.import_file, e))
+            return
+
+        except IOError, e:
+            logging.error('Import of %s failed: %s', self.import_file, e)
+            self.cancel_import()
+            tkMessageBox.showerror("Import failed", "Cannot read %s:\n%s" % (self.import_file, e))
+            return
+
+        self.dots.add_many(xs, ys)
+
+        # Only the new dots in view get items, once there are enough dots in view the dot layer
+        # is rasterized again as a whole
+        self.drawDots(self.canvas)
+
+        self.import_status = "Importing %s: %d dots (%d%%)  -  Esc to cancel" % (os.path.basename(self.import_file), len(self.dots), done * 100)
+        self.status.config(text=self.import_status)
+
+        self.import_job = self.canvas.after(1, self.import_step)
+
+    def cancel_import(self, event=None):
+
+        if self.importer:
+            logging.info('Import of %s cancelled', self.import_file)
+            self.canvas.after_cancel(self.import_job)
+            self.importer.close()
+            self.importer = None
+            self.import_status = ""
+
+            # Take out the dots imported so far
+            self.clearDots(self.canvas)
+            self.dots.clear()
+            self.status.config(text="Import cancelled")
 
     def save_csv(self):
 
-        # Save the dots to a CSV file
-        if self.dots:
+        # Save the dots to a CSV file, and the lines (if any) to a <name>_lines.csv next to it
+        if self.dots or self.lines:
             f_name = tkFileDialog.asksaveasfile(mode='wt', defaultextension=".csv")
             if f_name:
                 try:
-                    writer = csv.writer(f_name)
+                    write_dots_csv(f_name, self.dots.rows())
+                finally:
+                    f_name.close()
+
+                if self.lines:
+                    lines_file = os.path.splitext(f_name.name)[0] + "_lines.csv"
+                    f = open(lines_file, 'wt')
+                    try:
+                        writer = csv.writer(f)
+                        writer.writerow(('Line', 'X', 'Y'))
+                        for (n, line) in enumerate(self.lines):
+                            writer.writerows((n, x, y) for (x, y) in line.tolist())
+                    finally:
+                        f.close()
+                    logging.info('%d lines saved to %s', len(self.lines), lines_file)
+
+    def save_session(self):
+
+        # Save the dots, grid and field azimuth in a session file, after that the
+        # changes are appended to the session's journal as they're made
+        if not self.raw_image:
+            return
 
-                    writer.writerow(('X', 'Y', 'Horizon', 'Azimuth'))
+        session_file = self.session
+        if not session_file:
+            session_file = tkFileDialog.asksaveasfilename(**self.session_opt)
+            if not session_file:
+                logging.info('No file selected')
+                return
 
-                    rows = len(self.dots)
-                    for row in xrange(rows):
-                        writer.writerow(self.dots[row])
+        grid = (self.center, self.radius, self.showGrid, self.anchor, self.field_azimuth, self.field_azimuth_coords)
+        stamp = write_session(session_file, self.imageFile, grid, self.dots.columns(), self.dots.next_id, self.lines)
+        logging.info('Saved %d dots to session %s', len(self.dots), session_file)
 
-                finally:
-                    f_name.close()
+        self.close_session()
+        self.session = session_file
+        self.journal = SessionJournal(session_file + ".journal", stamp)
+        self.dots.journal = self.journal
+        self.status.config(text="Saved session %s" % os.path.basename(session_file))
+
+    def open_session(self):
+
+        session_file = tkFileDialog.askopenfilename(**self.session_opt)
+        if not session_file:
+            logging.info('No file selected')
+            return
+
+        try:
+            session = read_session(session_file)
+        except (IOError, ValueError, struct.error), e:
+            logging.error('Cannot open session %s: %s', session_file, e)
+            tkMessageBox.showerror("Open Session", "Cannot open %s:\n%s" % (session_file, e))
+            return
+
+        # The session is applied once its image is open
+        self.open_image(session[1], (session_file, session))
+
+    ####################################################################
+    # Function: apply_session(), restore the state saved in a session file, with the
+    #           changes in its journal, and keep journaling the changes from there
+    # Args:  session_file   name of session file
+    #        session        what read_session() returned for it
+    # Returns:  None
+    ####################################################################
+    def apply_session(self, session_file, session):
+
+        (stamp, image_file, grid, next_id, columns, lines) = session
+        (self.center, self.radius, self.showGrid, self.anchor, self.field_azimuth, self.field_azimuth_coords) = grid
+        self.dots.load(*(columns + (next_id,)))
+        self.lines = list(lines)
+
+        (records, journal) = open_journal(session_file + ".journal", stamp)
+        replay_journal(self, records)
+        logging.info('Opened session %s: %d dots, %d changes since it was saved', session_file, len(self.dots), len(records))
+
+        self.session = session_file
+        self.journal = journal
+        self.dots.journal = self.journal
+
+        self.clearDots(self.canvas)
+        self.canvas.delete("line")
+        self.lines_drawn = 0
+        self.request_redraw()
+
+    def close_session(self):
+
+        if self.journal:
+            self.journal.close()
+        self.journal = None
+        self.dots.journal = None
+        self.session = None
+
+    ####################################################################
+    # Function: adjust_tone(), change the exposure (in stops) and contrast of a 16 bit image
+    # Args:  exposure       stops added to the exposure
+    #        contrast       factor the contrast is multiplied by
+    # Returns:  None
+    # Only the lookup table changes, the view is rendered again from the same pixels.
+    ####################################################################
+    def adjust_tone(self, exposure=0, contrast=1.0):
+
+        if not isinstance(self.raw_image, HighBitImage):
+            logging.info('Exposure and contrast can only be adjusted for 16 bit images')
+            return
+
+        tone = self.raw_image.tone
+        tone.exposure += exposure
+        tone.contrast *= contrast
+        self.status.config(text="Exposure = %+.1f, Contrast = %.2f" % (tone.exposure, tone.contrast))
+        self.request_redraw()
+
+    def reset_tone(self):
+
+        if isinstance(self.raw_image, HighBitImage):
+            self.raw_image.tone.exposure = 0.0
+            self.raw_image.tone.contrast = 1.0
+        self.adjust_tone()
 
     def exit_app(self):
         sys.exit(0)
@@ -459,11 +2664,8 @@ class LoadImageApp:
 
         text = "X , Y = "
 
-        rows = len(self.dots)
-        for row in xrange(rows):
-            i = self.dots[row]
-
-            text = text + "(" + str(i[0]) + " , " + str(i[1]) + "), "
+        (ids, xs, ys, horizons, azimuths) = self.dots.columns()
+        text = text + "".join(["(" + str(x) + " , " + str(y) + "), " for (x, y) in zip(xs.tolist(), ys.tolist())])
 
         return text
 
@@ -480,13 +2682,19 @@ class LoadImageApp:
                 if not self.showGrid:
                     self.showGrid = d.result
 
+                if self.journal:
+                    self.journal.grid(self.center, self.radius, self.showGrid)
+
                 if self.showGrid:
                     self.drawGrid(self.canvas, d.center, d.radius)
 
     def hide_grid(self):
         if self.raw_image:
             self.showGrid = False
-            self.canvas.delete("grid")
+            self.canvas.delete("grid", "azimuth", "anchor")
+
+            if self.journal:
+                self.journal.grid(self.center, self.radius, self.showGrid)
 
     def define_azimuth(self):
 
@@ -505,8 +2713,7 @@ class LoadImageApp:
         if self.raw_image:
             if self.zoomcycle < self.MAX_ZOOM:
                 self.zoomcycle += 1
-                self.scale_image()
-                self.display_region(self.canvas)
+                self.request_redraw(interactive=True)
             else:
                 print "Max zoom reached!"
 
@@ -514,8 +2721,7 @@ class LoadImageApp:
         if self.raw_image:
             if self.zoomcycle > self.MIN_ZOOM:
                 self.zoomcycle -= 1
-                self.scale_image()
-                self.display_region(self.canvas)
+                self.request_redraw(interactive=True)
             else:
                 print "Min zoom reached!"
 
@@ -525,7 +2731,8 @@ class LoadImageApp:
 
     def zoomer(self,event):
 
-        logging.debug('zoomer()')
+        if self.debug:
+            logging.debug('zoomer()')
 
         # Zoom image and update viewport based on mouse position
         if self.raw_image:
@@ -539,39 +2746,52 @@ class LoadImageApp:
                 logging.info('Max/Min zoom reached!')
                 return
 
-            self.scale_image()
-
             self.viewport = (int(x * self.mux[self.zoomcycle]) - x, int(y * self.mux[self.zoomcycle]) - y)
-            self.display_region(self.canvas)
+            self.request_redraw(interactive=True)
 
     def b1down(self,event):
 
-        logging.debug('b1down() at (%d,%d)', event.x, event.y)
+        if self.debug:
+            logging.debug('b1down() at (%d,%d)', event.x, event.y)
         if self.raw_image:
             if self.tool is "dot":
 
                 item = event.widget.create_oval(event.x-2,event.y-2,event.x+2,event.y+2,fill="blue")
 
-                # save the dot in the raw_image aspect ratio
-                raw = self.to_raw((event.x,event.y))
-                event.widget.itemconfig(item, tags=("dot", str(raw[0]), str(raw[1])))
+                # save the dot in the raw_image aspect ratio, where it is on the image shown
+                raw = self.to_raw((event.x,event.y), shown=True)
+
+                # Calcualte the horizon elevation and azimuth if field azimuth is defined and grid is visable,
+                # they're looked up for the pixel when there's a lookup for the grid
+                lookup = self.horizon_lookup()
+                if lookup:
+                    (horizons, azimuths) = lookup.values(self.center, self.radius, self.field_azimuth_coords, [raw[0]], [raw[1]])
+                    (horizon, azimuth) = (horizons[0], azimuths[0])
+                    logging.info('Dot (%d,%d) has Horizon Elevation = %f, Azimuth = %f', raw[0], raw[1], horizon, azimuth)
+
+                    dot_id = self.dots.add(raw[0], raw[1], horizon, azimuth)
 
-                # Calcualte the horizon elevation and azimuth if field azimuth is defined and grid is visable
-                if self.showGrid and self.field_azimuth >= 0 and self.field_azimuth <= 360:
+                elif self.showGrid and self.field_azimuth >= 0 and self.field_azimuth <= 360:
 
                     azimuth = self.find_angle(self.center, self.field_azimuth_coords, (raw[0], raw[1]))
 
                     # (x-center.x)2 + (y-center.y)2 = r2
                     dot_radius = math.sqrt(math.pow(raw[0]-self.center[0],2)+math.pow(raw[1]-self.center[1],2))
-                    logging.debug('Dot (%d,%d) has radius %f', raw[0], raw[1], dot_radius)
+                    if self.debug:
+                        logging.debug('Dot (%d,%d) has radius %f', raw[0], raw[1], dot_radius)
                     horizon = self.find_horizon(dot_radius, self.radius)
                     logging.info('Dot (%d,%d) has Horizon Elevation = %f, Azimuth = %f', raw[0], raw[1], horizon, azimuth)
 
-                    new_dot = [raw[0], raw[1], round(horizon,5), round(azimuth,5)]
-                    self.dots.append(new_dot)
+                    dot_id = self.dots.add(raw[0], raw[1], round(horizon,5), round(azimuth,5))
 
                 else:
-                    self.dots.append(raw)
+                    dot_id = self.dots.add(raw[0], raw[1])
+
+                event.widget.itemconfig(item, tags=("dot", "dot%d" % dot_id))
+                if not self.dot_items:
+                    ((vx, vy), scale) = self.transform(shown=True)
+                    self.dots_at = (scale, vx, vy)
+                self.dot_items[dot_id] = item
 
             else:   # If tool is set to other functions: select or azimuth
 
@@ -580,24 +2800,23 @@ class LoadImageApp:
                 self.button_1 = "down"       # you only want to draw when the button is down
                                              # because "Motion" events happen -all the time-
 
-                if self.showGrid and self.tool is "azimuth":
-
-                    old_anchor = event.widget.find_withtag("anchor")
-                    if old_anchor:
-                        event.widget.delete(old_anchor)
+                if self.tool is "line":
+                    # start a stroke, it's drawn as one polyline that grows with the motion events
+                    self.stroke = [self.to_raw((event.x,event.y), shown=True)]
+                    event.widget.create_line(event.x, event.y, event.x, event.y, smooth=TRUE, fill="blue", width=5, tags="stroke")
 
-                    item = event.widget.create_oval(event.x-2,event.y-2,event.x+2,event.y+2,fill="orange")
+                if self.showGrid and self.tool is "azimuth":
 
-                    # save the anchor in the raw_image aspect ratio
-                    self.anchor = self.to_raw((event.x,event.y))
-                    event.widget.itemconfig(item, tags=("anchor"))
+                    # save the anchor in the raw_image aspect ratio, drawAzimuth() moves the anchor there
+                    self.anchor = self.to_raw((event.x,event.y), shown=True)
 
                     logging.debug('Button down, drawing azimuth line with 0 degree')
                     self.drawAzimuth(self.canvas, self.center, self.radius, 0, self.anchor)
 
     def b1up(self,event):
 
-        logging.debug('b1up()-> tool = %s at (%d, %d)', self.tool, event.x, event.y)
+        if self.debug:
+            logging.debug('b1up()-> tool = %s at (%d, %d)', self.tool, event.x, event.y)
         if not self.raw_image:
             return
 
@@ -605,58 +2824,92 @@ class LoadImageApp:
         self.xold = None           # reset xold and yold when you let go of the button
         self.yold = None
 
-        # Handles dot deletion here, use canvas.find_enclosed to find items contained within the selection rectangles
+        # Handles dot deletion here, the dots inside the selection rectangle are looked up
+        # in the spatial index by their raw image coords
         if self.tool is "select":
-            items = event.widget.find_enclosed(self.select_X, self.select_Y, event.x, event.y)
 
             # delete the rectangle since we already found all items enclosed in it
             rect = event.widget.find_withtag("selection_rectangle")
             if rect:
                 event.widget.delete(rect)
 
-            found_dots = {}     # A dictionry that stores the item ID as key and dot coords as value
-
-            for i in items:
-
-                # Change the color of the selected dots to "red"
-                event.widget.itemconfig(i,fill="red")
-
-                tags = event.widget.gettags(i)
-                logging.debug('Selected Item-> %d with tags %s, %s, %s', i, tags[0], tags[1], tags[2])
-
-                if tags[0] == "dot":
-                    found_dots[i] = (int(tags[1]),int(tags[2]))       # save the i->tags as key->value pair in dictionary
+            ((vx, vy), scale) = self.transform(shown=True)
+            found_dots = self.dots.query((min(self.select_X, event.x) + vx) / scale,
+                                         (min(self.select_Y, event.y) + vy) / scale,
+                                         (max(self.select_X, event.x) + vx) / scale,
+                                         (max(self.select_Y, event.y) + vy) / scale).tolist()
 
             # If there's dots found, pop up an dialog to confirm the deletion
             if found_dots:
+
+                # Change the color of the selected dots to "red", rasterized dots get a red layer on top
+                rastered = self.dot_layer is not None
+                if rastered:
+                    (xs, ys) = self.dots.coords(found_dots)
+                    self.selected_layer = self.rasterDots(xs, ys, (255, 0, 0, 255))
+                    event.widget.create_image(-self.pan_buffer, -self.pan_buffer, image=self.selected_layer, anchor="nw", tags="selected")
+                else:
+                    for dot_id in found_dots:
+                        event.widget.itemconfig("dot%d" % dot_id, fill="red")
+
                 result = tkMessageBox.askokcancel("Confirm deletion?","Press OK to delete selected dot(s)!")
+                event.widget.delete("selected")
+                self.selected_layer = None
 
                 # If user confirms deletion
                 if result:
-                    # Delete the selected dots on the canvas, and remove it from "dots" list
-                    for i,coords in found_dots.items():
-                        logging.debug('Removing dot %d with coords: %d, %d', i, coords[0], coords[1])
-
-                        rows = len(self.dots)
-                        for row in xrange(rows):
-                            dot = self.dots[row]
+                    # Remove the selected dots from the dot store in one go, and delete them on the canvas
+                    logging.debug('Removing %d dots', len(found_dots))
+                    self.dots.delete_many(found_dots)
 
-                            if coords[0] == dot[0] and coords[1] == dot[1]:
-                                self.dots.remove(dot)
-                                break
-
-                        event.widget.delete(i)
+                    if rastered:
+                        self.drawDots(event.widget)
+                    else:
+                        for dot_id in found_dots:
+                            item = self.dot_items.pop(dot_id, None)
+                            if item:
+                                event.widget.delete(item)
 
                 else: # User cancel the deletion
                     logging.info('Dot deletion cancelled!')
 
                     # Change color of dot back to blue if user cancel deletion
-                    for i in found_dots.keys():
-                        event.widget.itemconfig(i,fill="blue")
+                    if not rastered:
+                        for dot_id in found_dots:
+                            event.widget.itemconfig("dot%d" % dot_id, fill="blue")
 
         elif self.tool is "azimuth":
+            if self.journal:
+                self.journal.azimuth(self.anchor, self.field_azimuth)
             self.azimuth_calculation(self.center, self.radius, self.field_azimuth_coords)
 
+        elif self.tool is "line" and self.stroke:
+            self.finish_stroke(event.widget)
+
+        elif self.tool is "move" and (self.pan_buffer or self.redraw_pending):
+            # Panning is done, go back to a window sized image
+            self.request_redraw()
+
+
+    def finish_stroke(self, my_canvas):
+
+        # Keep the stroke as a simplified line in raw coords, the tolerance is in window pixels
+        points = numpy.array(self.stroke, dtype=numpy.int32)
+        self.stroke = None
+        my_canvas.delete("stroke")
+
+        if len(points) < 2:
+            return
+
+        line = simplify_line(points, self.LINE_TOLERANCE / self.transform(shown=True)[1])
+        if self.debug:
+            logging.debug('Line of %d points, %d after simplifying', len(points), len(line))
+
+        self.lines.append(line)
+        if self.journal:
+            self.journal.line_added(len(self.lines) - 1, line)
+
+        self.drawLines(my_canvas)
 
     # Handles mouse movement, depends on what's the current mouse function
     def motion(self,event):
@@ -666,25 +2919,49 @@ class LoadImageApp:
             if self.xold is not None and self.yold is not None:
 
                 # Handles different functions differently
-                if self.tool is "line":
-                    # here's where you draw line. smooth. neat.
-                    event.widget.create_line(self.xold,self.yold,event.x,event.y,smooth=TRUE,fill="blue",width=5)
+                if self.tool is "line" and self.stroke:
+                    # here's where you draw line. smooth. neat. A point is only added once the mouse
+                    # is LINE_STEP away from the last one, and the stroke's polyline is updated in place
+                    (lx, ly) = self.to_window(self.stroke[-1], shown=True)
+                    if abs(event.x - lx) >= self.LINE_STEP or abs(event.y - ly) >= self.LINE_STEP:
+                        self.stroke.append(self.to_raw((event.x,event.y), shown=True))
+                        coords = event.widget.coords("stroke")
+                        event.widget.coords("stroke", *(coords + [event.x, event.y]))
 
                 elif self.tool is "azimuth":   # Defining Field Azimuth
 
                     # Draw a dotted azimuth line to show Field Azimuth (in zoomed window)
                     if self.showGrid:
                         # Find angle in the zoomed image ratio
-                        zoomed_center = self.to_window(self.center)
-                        zoomed_anchor = self.to_window(self.anchor)
+                        zoomed_center = self.to_window(self.center, shown=True)
+                        zoomed_anchor = self.to_window(self.anchor, shown=True)
 
                         self.field_azimuth = self.find_angle(zoomed_center, zoomed_anchor, (event.x,event.y))
                         self.drawAzimuth(self.canvas, self.center, self.radius, self.field_azimuth, self.anchor)
 
                 elif self.tool is "move":     # Panning
-                    # update the viewport and redraw the canvas
+                    # update the viewport, and slide what's already on the canvas as long as the
+                    # overscan still covers the window. Only render again (with a fresh overscan)
+                    # once the drag runs past the edge of the buffer.
                     self.viewport = (self.viewport[0] - (event.x - self.xold), self.viewport[1] - (event.y - self.yold))
-                    self.display_region(self.canvas)
+                    ox, oy = self.pan_origin[0] - self.viewport[0], self.pan_origin[1] - self.viewport[1]
+
+                    if abs(ox) <= self.pan_buffer and abs(oy) <= self.pan_buffer:
+                        (dx, dy) = (ox - self.pan_offset[0], oy - self.pan_offset[1])
+                        self.canvas.move("all", dx, dy)
+
+                        # the items are now where the new viewport puts them
+                        if self.grid_at:
+                            self.grid_at = (self.grid_at[0], self.grid_at[1] - dx, self.grid_at[2] - dy)
+                        if self.shown_at:
+                            self.shown_at = (self.shown_at[0], self.shown_at[1] - dx, self.shown_at[2] - dy)
+                        if self.dots_at:
+                            self.dots_at = (self.dots_at[0], self.dots_at[1] - dx, self.dots_at[2] - dy)
+                        if self.lines_at:
+                            self.lines_at = (self.lines_at[0], self.lines_at[1] - dx, self.lines_at[2] - dy)
+                        self.pan_offset = (ox, oy)
+                    else:
+                        self.request_redraw(self.PAN_OVERSCAN, interactive=True)
 
                 elif self.tool is "select":
                     # Draw a dotted rectangle to show the area selected
@@ -697,15 +2974,26 @@ class LoadImageApp:
             self.yold = event.y
 
         # update the status bar with x,y values, status bar always shows "RAW" coordinates
-        (rX,rY) = self.to_raw((event.x,event.y))
+        (rX,rY) = self.to_raw((event.x,event.y), shown=True)
         output = "Cursor = %d, %d" % (rX,rY)
         if self.field_azimuth:
             output += "      Field Azimuth = %d" %self.field_azimuth
+
+        # Horizon Elevation and Azimuth under the cursor, once there's a lookup for the grid
+        lookup = self.horizon_lookup()
+        if lookup and 0 <= rX < lookup.size[0] and 0 <= rY < lookup.size[1]:
+            (horizons, azimuths) = lookup.values(self.center, self.radius, self.field_azimuth_coords, [rX], [rY])
+            output += "      Horizon Elevation = %.2f, Azimuth = %.2f" % (horizons[0], azimuths[0])
+        self.cursor_status = output
+        if self.import_status:
+            output += "      " + self.import_status
+        if self.profile_status:
+            output += "      " + self.profile_status
         self.status.config(text=output)
 
     def resize_window(self, event):
-        if self.zoomed_image:
-            self.display_region(self.canvas)
+        if self.raw_image:
+            self.request_redraw(interactive=True)
 
     def azimuth_calculation(self, center, radius, azimuth_coords):
 
@@ -714,72 +3002,555 @@ class LoadImageApp:
 
         logging.info('-------- Calculating Horizon Elevation and Azimuth for dots --------')
 
-        # calculate horizon elevation and azimuth for each points
-        # and update dots list with horizon elevation and azimuth
-        new_dots = []
+        # calculate horizon elevation and azimuth for all the points in one pass
+        # and update the dots with horizon elevation and azimuth
+        update_dots(self.dots, center, radius, azimuth_coords, self.horizon_lookup())
+
+        if self.journal:
+            self.journal.calculated()
+
+        logging.info('Horizon Elevation and Azimuth calculated for %d dots', len(self.dots))
+        if self.debug:
+            for dot in self.dots.rows():
+                logging.debug('Dot (%d,%d) has Horizon Elevation = %f, Azimuth = %f', dot[0], dot[1], dot[2], dot[3])
+
+    ####################################################################
+    # Function: horizon_lookup(), the HorizonLookup of the current grid
+    # Returns:  HorizonLookup, None if the field azimuth isn't defined, the image is too
+    #           large to keep one in memory or it's still being built. It's built on a
+    #           thread of its own, one at a time, the first time it's asked for.
+    ####################################################################
+    def horizon_lookup(self):
+
+        if not (self.raw_image and self.showGrid and self.field_azimuth >= 0 and self.field_azimuth <= 360):
+            return None
+
+        key = (tuple(self.raw_image.size), tuple(self.center), self.radius)
+        lookup = self.lookup
+        if lookup and lookup.key == key:
+            return lookup
 
-        rows = len(self.dots)
-        for row in xrange(rows):
-            dot = self.dots.pop()
+        (w, h) = self.raw_image.size
+        if self.lookup_building is None and key != self.lookup_failed and (w * h <= self.LOOKUP_PIXELS or self.LOOKUP_CACHE):
+            self.lookup = None      # let the old one go before building the new one
+            self.lookup_building = key
+            # not a daemon, so a lookup being saved (-l) is finished when the viewer exits
+            threading.Thread(target=self.build_lookup, args=key).start()
 
-            azimuth = self.find_angle(center, azimuth_coords, (dot[0], dot[1]))
+        return None
 
-            # (x-center.x)2 + (y-center.y)2 = r2
-            dot_radius = math.sqrt(math.pow(dot[0]-center[0],2)+math.pow(dot[1]-center[1],2))
-            horizon = self.find_horizon(dot_radius, radius)
-            logging.info('Dot (%d,%d) has Horizon Elevation = %f, Azimuth = %f', dot[0], dot[1], horizon, azimuth)
+    def build_lookup(self, size, center, radius):
 
-            new_dot = [dot[0], dot[1], round(horizon,5), round(azimuth,5)]
-            new_dots.append(new_dot)
+        # On the lookup thread. If the grid has changed meanwhile, the next horizon_lookup() starts another.
+        # One that fails isn't built again until the grid changes (and back).
+        try:
+            self.lookup = HorizonLookup(size, center, radius, self.LOOKUP_CACHE, self.LOOKUP_CACHE_BYTES)
+        except (OSError, IOError, ValueError, MemoryError), e:
+            logging.warning('Horizon lookup for center = %s, radius = %d not built: %s', center, radius, e)
+            self.lookup_failed = (size, center, radius)
+        finally:
+            self.lookup_building = None
 
-        self.dots = new_dots
+    ####################################################################
+    # Function: profile_sample(), sample the gauges and refresh the profile
+    #           summary in the status bar, every PROFILE_INTERVAL while profiling
+    # Returns:  None
+    ####################################################################
+    def profile_sample(self):
+
+        profiler = self.profiler
+
+        profiler.gauge("dots", len(self.dots))
+        profiler.gauge("dots_drawn", self.dots_drawn)
+        profiler.gauge("dot_items", len(self.canvas.find_withtag("dot")))
+        profiler.gauge("dots_rasterized", int(self.dot_layer is not None))
+
+        # decoded image memory: the full resolution image, the pyramid levels built
+        # so far (not the ones mapped from the tile cache) and the images prepared by the loader
+        image_bytes = 0
+        if self.raw_image:
+            image_bytes += self.raw_image.nbytes
+            for level in self.pyramid.levels[1:]:
+                if isinstance(level, HighBitImage):
+                    image_bytes += level.nbytes
+                elif not isinstance(level, TiledImage):
+                    image_bytes += level.size[0] * level.size[1] * len(level.getbands())
+        profiler.gauge("image_bytes", image_bytes)
+
+        loader_bytes = 0
+        for job in self.loader.jobs.values():
+            if job.ready() and job.successful() and job.get()[0] is not self.raw_image:
+                loader_bytes += job.get()[0].nbytes
+        profiler.gauge("prefetch_bytes", loader_bytes)
+
+        # frames per second since the last sample
+        frames = profiler.count("frame")
+        fps = (frames - self.profile_frames) * 1000.0 / self.PROFILE_INTERVAL
+        self.profile_frames = frames
+        profiler.gauge("fps", fps)
+
+        output = "%.0f fps" % fps
+        if frames:
+            output += ", frame p95 %s ms" % profiler.percentile("frame", 0.95)
+        output += ", %d dots (%d drawn), %d MB" % (len(self.dots), self.dots_drawn, (image_bytes + loader_bytes) >> 20)
+        self.profile_status = output
+
+        text = self.cursor_status
+        for part in (self.import_status, self.profile_status):
+            if part:
+                text += ("      " if text else "") + part
+        self.status.config(text=text)
+
+        self.canvas.after(self.PROFILE_INTERVAL, self.profile_sample)
 
     # Find angle between 2 points in range of 0 to 360 in clockwise direction
     def find_angle(self, C, P2, P3):
+        return float(find_angle_array(C, P2, P3[0], P3[1]))
+
+    def find_horizon(self, dot_radius, grid_radius):
+        return float(find_horizon_array(dot_radius, grid_radius))
+
+####################################################################
+# Batch mode: calculates Horizon Elevation and Azimuth for many images
+# without the GUI. The manifest is a CSV file with a header row and one job
+# per row:
+#     Image, CSV, Center X, Center Y, Radius, Field Azimuth[, Anchor X, Anchor Y[, Output]]
+# Center and radius may be left empty to use the image defaults. Field
+# azimuth is in degrees clockwise from the anchor point, which defaults to
+# the east end of the grid (so it's the angle from the image X axis). The
+# output CSV defaults to <CSV>_horizon.csv. Relative paths are taken from
+# the directory of the manifest.
+####################################################################
+
+def read_manifest(manifest_file):
+
+    jobs = []
+    outputs = {}        # output file -> manifest line, two jobs writing one file would overwrite each other
+    base = os.path.dirname(os.path.abspath(manifest_file))
+
+    f = open(manifest_file, 'rt')
+    try:
+        reader = csv.reader(f)
+        reader.next()       # header
+
+        for row in reader:
+            if not row:
+                continue
+
+            row = [value.strip() for value in row] + [''] * (9 - len(row))
+            image_file = os.path.join(base, row[0])
+            csv_file = os.path.join(base, row[1])
+            center = (int(row[2]), int(row[3])) if row[2] and row[3] else None
+            radius = int(row[4]) if row[4] else None
+            anchor = (int(row[6]), int(row[7])) if row[6] and row[7] else None
+            output = os.path.join(base, row[8]) if row[8] else os.path.splitext(csv_file)[0] + '_horizon.csv'
+            if output in outputs:
+                raise ValueError("line %d writes %s, like line %d (give the rows their own Output)" %
+                                 (reader.line_num, output, outputs[output]))
+            outputs[output] = reader.line_num
+
+            jobs.append((image_file, csv_file, center, radius, float(row[5]), anchor, output))
+    finally:
+        f.close()
+
+    return jobs
+
+def batch_job(job):
+
+    # Runs in a worker process, returns (output file, number of dots, error message or None)
+    (image_file, csv_file, center, radius, field_azimuth, anchor, output) = job
+
+    try:
+        # The image header is only read for the default grid, the pixels are never decoded
+        if center is None or radius is None:
+            (default_center, default_radius) = default_grid(Image.open(image_file).size)
+            center = center or default_center
+            radius = radius or default_radius
+
+        azimuth_coords = field_azimuth_end(center, radius, field_azimuth, anchor or (center[0] + radius, center[1]))
+        if azimuth_coords is None:
+            return (output, 0, "field azimuth %s is out of range" % field_azimuth)
+
+        (xs, ys) = read_dots_csv(csv_file)
+        (horizons, azimuths) = calculate_dots(center, radius, azimuth_coords, xs, ys)
+
+        f = open(output, 'wb')
+        try:
+            write_dots_csv(f, zip(xs, ys, horizons, azimuths))
+        finally:
+            f.close()
+
+        return (output, len(xs), None)
+
+    except Exception, e:
+        return (output, 0, "%s: %s" % (csv_file, e))
+
+def run_batch(manifest_file, processes=None):
+
+    # Run the jobs over a process pool, each output CSV is written as soon as its job is done
+    jobs = read_manifest(manifest_file)
+    logging.info('Batch: %d jobs from %s', len(jobs), manifest_file)
+
+    import multiprocessing
+    failed = 0
+    pool = multiprocessing.Pool(processes)
+    try:
+        for (output, count, error) in pool.imap_unordered(batch_job, jobs):
+            if error:
+                failed += 1
+                logging.error('Batch: %s', error)
+            else:
+                logging.info('Batch: %d dots written to %s', count, output)
+    finally:
+        pool.close()
+        pool.join()
+
+    return failed
+
+
+####################################################################
+# Server mode: serves an image as tiles, and its session (dots, lines,
+# grid and field azimuth) as JSON, over HTTP on localhost, without the GUI:
+#     /info                           image size, tile size and zoom factors
+#     /tiles/<zoomcycle>/<x>/<y>.png  tile x,y of the image zoomed by mux[zoomcycle]
+#                                     (.jpg for JPEG)
+#     /dots[?bbox=x0,y0,x1,y1]        dots, in raw image coords
+#     /lines                          lines, in raw image coords
+#     /grid                           grid and field azimuth
+# Every request runs on a thread of its own, any number of clients can
+# browse at once.
+####################################################################
+
+####################################################################
+# Class: ServedSession
+# The dots, lines, grid and field azimuth of a session file with the
+# changes in its journal, read the way the viewer opens a session.
+####################################################################
+class ServedSession:
+
+    def __init__(self, image_size, session_file=None):
+        self.dots = DotStore()
+        self.lines = []
+        (self.center, self.radius) = default_grid(image_size)
+        self.showGrid = False
+        self.anchor = (0,0)
+        self.field_azimuth = -1
+        self.field_azimuth_coords = (0,0)
 
-        logging.debug('Finding Angle -> center = %d, %d, P2 = %d, %d, P3 = %d, %d', C[0], C[1], P2[0], P2[1], P3[0], P3[1])
+        if session_file:
+            (stamp, image_file, grid, next_id, columns, lines) = read_session(session_file)
+            (self.center, self.radius, self.showGrid, self.anchor, self.field_azimuth, self.field_azimuth_coords) = grid
+            self.dots.load(*(columns + (next_id,)))
+            self.lines = list(lines)
+            replay_journal(self, read_journal(session_file + ".journal", stamp)[0])
 
-        angle = math.atan2(P2[1]-C[1], P2[0]-C[0]) - math.atan2(P3[1]-C[1], P3[0]-C[0])
-        angle_in_degree = math.degrees(angle)
-        logging.debug("***** Angle in degree = %d", angle_in_degree)
+        # columns() compacts the store after deletes, done here so the request threads only ever read
+        self.dots.columns()
 
-        if angle_in_degree <= 0:
-            adjusted_angle = math.fabs(0 - angle_in_degree)
+####################################################################
+# Class: TileService
+# What the server serves: tiles of the image for each zoom factor of the
+# viewer's mux table, rendered from one ImagePyramid shared by all the
+# requests and kept encoded (least recently used first) up to CACHE_BYTES,
+# and the ServedSession. The session is read again when the session file or
+# its journal changes, so the clients follow the analyst working on it.
+####################################################################
+class TileService:
+
+    TILE_SIZE = 256
+    CACHE_BYTES = 128 << 20     # encoded tiles kept in memory
+    FORMATS = {"png": ("PNG", "image/png"), "jpg": ("JPEG", "image/jpeg")}
+
+    def __init__(self, image_file, session_file=None, cache=None):
+        self.image_file = image_file
+        self.raw_image = open_raw_image(image_file, cache)
+        self.pyramid = ImagePyramid(self.raw_image, cache)
+        self.mux = zoom_factors(LoadImageApp.MIN_ZOOM, LoadImageApp.MAX_ZOOM)
+
+        self.tiles = OrderedDict()      # (zoomcycle, x, y, format) -> encoded tile
+        self.tile_bytes = 0
+        self.lock = threading.Lock()
+
+        self.session_file = session_file
+        self.session_version = None     # (mtime, size) of the session file and journal read
+        self.session = ServedSession(self.raw_image.size)
+        self.reload_session()
+
+    def reload_session(self):
+
+        # Read the session again if it changed since, the new one replaces the old one at once
+        if not self.session_file:
+            return self.session
+
+        version = []
+        for f in (self.session_file, self.session_file + ".journal"):
+            try:
+                stat = os.stat(f)
+                version.append((stat.st_mtime, stat.st_size))
+            except OSError:
+                version.append(None)
+
+        with self.lock:
+            if version != self.session_version:
+                try:
+                    self.session = ServedSession(self.raw_image.size, self.session_file)
+                except (ValueError, struct.error), e:
+                    # not the client's fault, it's reported as a server error
+                    raise IOError("can't read session %s: %s" % (self.session_file, e))
+                self.session_version = version
+                logging.info('Server: read session %s, %d dots', self.session_file, len(self.session.dots))
+
+        return self.session
+
+    def tile(self, zoomcycle, x, y, format):
+
+        key = (zoomcycle, x, y, format)
+        with self.lock:
+            data = self.tiles.pop(key, None)
+            if data is not None:
+                self.tiles[key] = data
+                return data
+
+        scale = self.mux[zoomcycle]
+        (w, h) = self.raw_image.size
+        if x < 0 or y < 0 or x * self.TILE_SIZE >= int(w * scale) or y * self.TILE_SIZE >= int(h * scale):
+            raise KeyError("no tile %d,%d at zoom %d" % (x, y, zoomcycle))
+
+        # Rendered outside of the lock, so tiles are rendered in parallel (PIL resizes without the GIL)
+        region = self.pyramid.render((x * self.TILE_SIZE, y * self.TILE_SIZE), (self.TILE_SIZE, self.TILE_SIZE), scale)
+        if format == "jpg" and region.mode not in ("L", "RGB"):
+            region = region.convert("RGB")      # JPEG has no alpha or palette
+        out = StringIO()
+        region.save(out, self.FORMATS[format][0])
+        data = out.getvalue()
+
+        with self.lock:
+            if key not in self.tiles:
+                self.tiles[key] = data
+                self.tile_bytes += len(data)
+            while self.tile_bytes > self.CACHE_BYTES:
+                self.tile_bytes -= len(self.tiles.popitem(last=False)[1])
+
+        return data
+
+    def info(self):
+
+        (w, h) = self.raw_image.size
+        return {"image": os.path.basename(self.image_file), "size": [w, h], "tile_size": self.TILE_SIZE,
+                "zooms": dict((str(n), scale) for (n, scale) in self.mux.items())}
+
+    def dots(self, bbox=None):
+
+        # [ID, X, Y, Horizon, Azimuth] of the dots (in bbox, if given), null while not calculated
+        (ids, xs, ys, horizons, azimuths) = self.reload_session().dots.columns()
+        if bbox:
+            (x0, y0, x1, y1) = bbox
+            inside = (xs >= x0) & (xs <= x1) & (ys >= y0) & (ys <= y1)
+            (ids, xs, ys, horizons, azimuths) = (ids[inside], xs[inside], ys[inside], horizons[inside], azimuths[inside])
+
+        rows = []
+        for (dot_id, x, y, horizon, azimuth) in zip(ids.tolist(), xs.tolist(), ys.tolist(), horizons.tolist(), azimuths.tolist()):
+            if horizon != horizon:      # NaN, not calculated
+                rows.append([dot_id, x, y, None, None])
+            else:
+                rows.append([dot_id, x, y, horizon, azimuth])
+
+        return {"count": len(rows), "dots": rows}
+
+    def lines(self):
+        return {"lines": [line.tolist() for line in self.reload_session().lines]}
+
+    def grid(self):
+
+        session = self.reload_session()
+        azimuth = session.field_azimuth if 0 <= session.field_azimuth <= 360 else None
+        return {"center": list(session.center), "radius": session.radius, "shown": session.showGrid,
+                "anchor": list(session.anchor), "field_azimuth": azimuth,
+                "field_azimuth_coords": list(session.field_azimuth_coords) if azimuth is not None else None}
+
+    def get(self, path, query):
+
+        # (content type, body) for a GET of path, KeyError if there's nothing there
+        # and ValueError if the request doesn't make sense
+        parts = path.strip("/").split("/")
+
+        if parts[0] == "tiles" and len(parts) == 4:
+            (y, dot, format) = parts[3].partition(".")
+            if format not in self.FORMATS:
+                raise KeyError(path)
+            (zoomcycle, x, y) = (int(parts[1]), int(parts[2]), int(y))
+            if zoomcycle not in self.mux:
+                raise ValueError("zoom %d is out of range" % zoomcycle)
+            return (self.FORMATS[format][1], self.tile(zoomcycle, x, y, format))
+
+        if parts == ["info"] or parts == [""]:
+            result = self.info()
+        elif parts == ["dots"]:
+            bbox = None
+            if "bbox" in query:
+                bbox = [float(v) for v in query["bbox"][0].split(",")]
+                if len(bbox) != 4:
+                    raise ValueError("bbox is x0,y0,x1,y1")
+            result = self.dots(bbox)
+        elif parts == ["lines"]:
+            result = self.lines()
+        elif parts == ["grid"]:
+            result = self.grid()
         else:
-            adjusted_angle = 360 - angle_in_degree
+            raise KeyError(path)
 
-        return adjusted_angle
+        return ("application/json", json.dumps(result))
 
-    def find_horizon(self, dot_radius, grid_radius):
+def make_server(service, port):
+
+    # An HTTP server on localhost for service, each request is handled on a thread of its own
+    import BaseHTTPServer
+    import SocketServer
+    import urlparse
+
+    class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+        def do_GET(self):
+            url = urlparse.urlparse(self.path)
+            try:
+                (content_type, body) = service.get(url.path, urlparse.parse_qs(url.query))
+            except KeyError:
+                self.send_error(404)
+                return
+            except ValueError, e:
+                self.send_error(400, str(e))
+                return
+            except Exception:
+                logging.exception('Server: GET %s failed', self.path)
+                self.send_error(500)
+                return
+
+            self.send_response(200)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            self.send_header("Access-Control-Allow-Origin", "*")
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            logging.debug('Server: %s %s', self.address_string(), format % args)
+
+    class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+        daemon_threads = True
+
+    return Server(('localhost', port), Handler)
+
+def run_server(image_file, port, session_file=None, cache=None):
+
+    service = TileService(image_file, session_file, cache)
+    server = make_server(service, port)
+    logging.info('Server: serving %s on http://localhost:%d/', image_file, server.server_address[1])
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
 
-        camera = 185
-        return (camera/2) - ((dot_radius/grid_radius) * (camera/2))
 
 # Main Program, checks to see if image file is provided in command line, if not, it will be opened via menu File->Open File
 
 if __name__ == '__main__':
-    root = Tk()
-    root.title("Image Viewer")
     image_file = None
+    manifest_file = None
+    processes = None
     debug_level = logging.INFO
+    report_file = None
+    port = None
+    session_file = None
 
-    opts, args = getopt.getopt(sys.argv[1:], 'f:dh')
+    opts, args = getopt.getopt(sys.argv[1:], 'f:r:b:j:p:l:c:m:i:w:s:e:dh')
 
     for opt, arg in opts:
         if opt == '-f':
             image_file = arg
         elif opt == '-d':
             debug_level = logging.DEBUG
+        elif opt == '-r':
+            LoadImageApp.FRAME_BUDGET = int(arg)
+        elif opt == '-i':
+            if arg.lower() not in LoadImageApp.FILTERS:
+                sys.exit("Unknown filter " + arg + ", use one of " + ", ".join(sorted(LoadImageApp.FILTERS)))
+            LoadImageApp.INTERACTIVE_FILTER = LoadImageApp.FILTERS[arg.lower()]
+        elif opt == '-w':
+            LoadImageApp.REFINE_DELAY = int(arg)
+        elif opt == '-b':
+            manifest_file = arg
+        elif opt == '-j':
+            processes = int(arg)
+        elif opt == '-p':
+            report_file = arg
+        elif opt == '-l':
+            LoadImageApp.LOOKUP_CACHE = arg
+        elif opt == '-c':
+            LoadImageApp.TILE_CACHE = arg
+        elif opt == '-m':
+            LoadImageApp.TILE_CACHE_BYTES = int(arg) << 20
+        elif opt == '-s':
+            port = int(arg)
+        elif opt == '-e':
+            session_file = arg
         elif opt == '-h':
-            print('Usage: python viewer.py -d -h -f <image_file>')
+            print('Usage: python viewer.py -d -h -f <image_file> -r <milliseconds> -p <report_file> -l <folder>')
+            print('                        -c <folder> -m <megabytes> -i <filter> -w <milliseconds>')
+            print('       python viewer.py -d -b <manifest_file> -j <processes>')
+            print('       python viewer.py -d -s <port> -f <image_file> -e <session_file> -c <folder>')
             print('       -d     turn on debug')
             print('       -h     help menu')
             print('       -f <image_file>   define image_file used')
+            print('       -r <milliseconds> minimum time between two redraws (default 16)')
+            print('       -i <filter>       filter used while zooming and panning: nearest, bilinear (default),')
+            print('                         bicubic or antialias (always the best quality)')
+            print('       -w <milliseconds> time without zooming or panning before the view is redrawn with')
+            print('                         antialias (default 150)')
+            print('       -l <folder>       save the Horizon Elevation lookups of the grids in folder')
+            print('       -c <folder>       save decoded images and zoom levels in folder, so they open faster next time')
+            print('       -m <megabytes>    size of the -c folder, least recently used files are deleted (default 2048)')
+            print('       -b <manifest_file> calculate Horizon Elevation and Azimuth for the CSV files')
+            print('                          listed in the manifest, without opening the window')
+            print('       -j <processes>    number of processes used by -b (default: one per CPU)')
+            print('       -s <port>         serve the image as tiles, and its dots, lines and grid as JSON,')
+            print('                         on http://localhost:<port>/ without opening the window')
+            print('       -e <session_file> session served by -s (its image, if -f is left out)')
+            print('       -p <report_file>  profile the viewer, the summary is shown in the status bar')
+            print('                         and a JSON report is written to report_file on exit')
             sys.exit()
 
     logging.basicConfig(level=debug_level,
                     format='%(asctime)s %(levelname)-8s %(message)s',
                     datefmt='%a, %d %b %Y %H:%M:%S')
+    LoadImageApp.debug = debug_level == logging.DEBUG
+
+    if LoadImageApp.LOOKUP_CACHE and not os.path.isdir(LoadImageApp.LOOKUP_CACHE):
+        os.makedirs(LoadImageApp.LOOKUP_CACHE)
+    if LoadImageApp.TILE_CACHE and not os.path.isdir(LoadImageApp.TILE_CACHE):
+        os.makedirs(LoadImageApp.TILE_CACHE)
+
+    if manifest_file:
+        if not os.path.isfile(manifest_file):
+            sys.exit("Manifest File " + manifest_file + " doesn't exist!")
+        try:
+            failed = run_batch(manifest_file, processes)
+        except ValueError, e:
+            sys.exit("Manifest File " + manifest_file + ": " + str(e))
+        sys.exit(1 if failed else 0)
+
+    if port is not None:
+        if session_file:
+            if not os.path.isfile(session_file):
+                sys.exit("Session File " + session_file + " doesn't exist!")
+            image_file = image_file or read_session(session_file)[1]
+        if not image_file or not os.path.isfile(image_file):
+            sys.exit("Image File " + str(image_file) + " doesn't exist!")
+
+        cache = TileCache(LoadImageApp.TILE_CACHE, LoadImageApp.TILE_CACHE_BYTES) if LoadImageApp.TILE_CACHE else None
+        run_server(image_file, port, session_file, cache)
+        sys.exit()
 
     if image_file:
         if os.path.isfile(image_file):
@@ -789,7 +3560,17 @@ if __name__ == '__main__':
             sys.exit(exit_string)
 
 
+    # Wrap the methods to be timed before the app binds them to events
+    if report_file:
+        profiler = Profiler(report_file)
+        profiler.instrument(LoadImageApp, LoadImageApp.PROFILED)
+        profiler.instrument(ImagePyramid, {"render": "render"})
+        LoadImageApp.profiler = profiler
+        atexit.register(profiler.dump)
+
     # Create and open app, if image_file is provided, open the image as well
+    root = Tk()
+    root.title("Image Viewer")
     App = LoadImageApp(root,image_file)
 
     root.mainloop()
\ No newline at end of file